@@ -0,0 +1,137 @@
+"""
+Fetches a row of data for each of many days on a pool of workers, each with a browser of its own.
+Page loads are rate limited across all workers, failed days are retried with backoff, and each finished day is
+checkpointed to disk so that an interrupted run resumes where it stopped.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_RETRIES = 3
+# seconds before the first retry of a day, doubling with each further one
+DEFAULT_BACKOFF = 2.0
+
+
+class RateLimiter:
+    """
+    Spaces out wait() calls, across all threads, to at most rate per second; 0 for no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+def load_checkpoint(filename):
+    """
+    :param filename: checkpoint written by backfill, or None
+    :return: rows of the days already fetched, by day
+    """
+    rows = {}
+    if filename is None or not os.path.exists(filename):
+        return rows
+    with open(filename) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line of a run killed mid-write
+                continue
+            rows[entry["day"]] = entry["row"]
+    return rows
+
+
+def backfill(days, fetch, make_driver, workers=1, rate=0, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+             retry_exceptions=(Exception,), checkpoint=None):
+    """
+    Fetch the row of each of days, skipping those already in checkpoint.
+    :param days: the days to fetch, as strings to key the checkpoint with
+    :param fetch: fetch(driver, day) -> row, a json serializable dict
+    :param make_driver: makes a driver (anything with a quit method) for a worker; called again after a failed
+    attempt, so a retry doesn't run in a browser left in a bad state
+    :param rate: most page loads per second, across all workers
+    :param retry_exceptions: exceptions of fetch to retry; any other stops the run and is raised
+    :param checkpoint: file to append each fetched day to, and to resume from
+    :return: rows of the days fetched, in days order, and the days that failed every attempt
+    """
+    done = load_checkpoint(checkpoint)
+    todo = queue.Queue()
+    for day in days:
+        if day not in done:
+            todo.put(day)
+    if done:
+        logging.info("Resuming from %s: %d of %d days already fetched", checkpoint,
+                     len(days) - todo.qsize(), len(days))
+    failed = []
+    lock = threading.Lock()
+    stop = threading.Event()
+    limiter = RateLimiter(rate)
+    checkpoint_file = open(checkpoint, "a") if checkpoint else None
+
+    def record(day, row):
+        with lock:
+            done[day] = row
+            if checkpoint_file is not None:
+                checkpoint_file.write(json.dumps({"day": day, "row": row}) + "\n")
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+
+    def work():
+        driver = None
+        try:
+            while not stop.is_set():
+                try:
+                    day = todo.get_nowait()
+                except queue.Empty:
+                    return
+                for attempt in range(retries + 1):
+                    if driver is None:
+                        driver = make_driver()
+                    limiter.wait()
+                    try:
+                        row = fetch(driver, day)
+                    except retry_exceptions as e:
+                        logging.warning("Attempt %d for %s failed: %r", attempt + 1, day, e)
+                        driver.quit()
+                        driver = None
+                        if attempt == retries or stop.wait(backoff * 2 ** attempt):
+                            with lock:
+                                failed.append(day)
+                            break
+                    else:
+                        record(day, row)
+                        break
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            if driver is not None:
+                driver.quit()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as executor:
+            futures = [executor.submit(work) for _ in range(workers)]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # e.g. ctrl-c: let the workers finish the days they're on, then stop
+                stop.set()
+                raise
+    finally:
+        if checkpoint_file is not None:
+            checkpoint_file.close()
+    failed = set(failed)
+    return [done[day] for day in days if day in done], [day for day in days if day in failed]
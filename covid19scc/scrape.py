@@ -3,15 +3,22 @@ import argparse
 import csv
 import datetime
 import logging
+import os
 import re
 import sys
 
 from selenium import webdriver
-from selenium.common.exceptions import WebDriverException, TimeoutException
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.support import expected_conditions as ec
 from selenium.webdriver.common.by import By
 
+try:
+    from covid19scc import backfill
+except ImportError:
+    # run as a script, ./scrape.py, with this directory rather than the package's parent on sys.path
+    import backfill
+
 DRIVERS = {
     "chrome": webdriver.Chrome,
     "safari": webdriver.Safari,
@@ -27,6 +34,11 @@ def get_driver(args, options=None):
 
 
 DEFAULT_OUTPUT_FILENAME = "covid_data.csv"
+# days fetched so far by a --days-past run are kept in <output> + this, until the run has fetched them all
+CHECKPOINT_SUFFIX = ".checkpoint.jsonl"
+WA_URL = "https://web.archive.org/web"
+# page loads per second across all drivers, to go easy on the web archive
+DEFAULT_RATE = 1.0
 
 
 def get_arg_parser():
@@ -41,6 +53,17 @@ def get_arg_parser():
                         default=DEFAULT_OUTPUT_FILENAME)
     parser.add_argument("-D", "--driver", choices=DRIVERS.keys(),
                         default="chrome", help="Select driver to use for crawl")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="drivers fetching --days-past days at once")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                        help="most page loads per second, across all drivers (0 for no limit)")
+    parser.add_argument("--retries", type=int, default=backfill.DEFAULT_RETRIES,
+                        help="times to retry a day that fails, with exponential backoff")
+    parser.add_argument("--checkpoint",
+                        help=f"file to record fetched days in and resume from (default: output + {CHECKPOINT_SUFFIX})")
+    parser.add_argument("--archive-url", default=WA_URL,
+                        help="web archive to fetch past days from, as <archive-url>/<YYYYMMDD>/<page url>; "
+                             "e.g. a local server of fixture pages")
     parser.add_argument("--loglevel", dest="loglevel", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         default="INFO", help="Set the logging level")
     return parser
@@ -155,21 +178,32 @@ WA_DATE_FORMAT = "%Y%m%d"
 DATA_DATE_FORMAT = WA_DATE_FORMAT
 
 
-def get_historical_data(driver, days_past, base):
-    dates = [base - datetime.timedelta(days=x) for x in range(days_past)]
-    data = []
-    for d in dates:
-        logging.info("Fetching data for %s", d.strftime(DATA_DATE_FORMAT))
-        url = f"https://web.archive.org/web/{d.strftime(WA_DATE_FORMAT)}/{URL_SCC_NOVCOVID}"
-        try:
-            datum = get_table_data(driver, url)
-        except TimeoutException:
-            logging.warning("Timeout, moving on.")
-            continue
-        datum["Date"] = d.strftime(DATA_DATE_FORMAT)
+def get_archive_url(archive_url, d):
+    return f"{archive_url}/{d.strftime(WA_DATE_FORMAT)}/{URL_SCC_NOVCOVID}"
+
+
+def get_historical_data(make_driver, days_past, base, workers=1, rate=DEFAULT_RATE, retries=backfill.DEFAULT_RETRIES,
+                        checkpoint=None, archive_url=WA_URL):
+    """
+    Fetch the table data of each of days_past days back from base, see backfill.backfill.
+    :param make_driver: function returning a new webdriver, one per worker
+    :return: data rows, newest first, and the days that couldn't be fetched
+    """
+    dates = {d.strftime(DATA_DATE_FORMAT): d for d in (base - datetime.timedelta(days=x) for x in range(days_past))}
+
+    def fetch_day(driver, day):
+        logging.info("Fetching data for %s", day)
+        datum = get_table_data(driver, get_archive_url(archive_url, dates[day]))
+        datum["Date"] = day
         logging.debug("data row: %s", datum)
-        data.append(datum)
-    return data
+        return datum
+
+    # timeouts included; a browser that crashed is replaced before the retry
+    data, failed = backfill.backfill(list(dates), fetch_day, make_driver, workers, rate, retries,
+                                     retry_exceptions=(WebDriverException,), checkpoint=checkpoint)
+    if failed:
+        logging.warning("Failed to fetch %d days, rerun to retry them: %s", len(failed), ", ".join(failed))
+    return data, failed
 
 
 COL_MAPPINGS = {
@@ -255,22 +289,26 @@ def main():
         logging.getLogger("urllib3").setLevel(logging.INFO)
         logging.getLogger("selenium").setLevel(logging.INFO)
 
-    logging.info("Booting webdriver...")
-    driver = get_driver(args)
-    try:
-        if args.days_past > 0:
-            base = datetime.datetime(2020, 3, 26)
-            logging.info("Getting %d days of historical data from %s...", args.days_past, base)
-            data = get_historical_data(driver, args.days_past, base)
-        else:
+    checkpoint = args.checkpoint or args.output + CHECKPOINT_SUFFIX
+    failed = []
+    if args.days_past > 0:
+        base = datetime.datetime(2020, 3, 26)
+        logging.info("Getting %d days of historical data from %s with %d drivers...", args.days_past, base,
+                     args.workers)
+        data, failed = get_historical_data(lambda: get_driver(args), args.days_past, base, args.workers, args.rate,
+                                           args.retries, checkpoint, args.archive_url)
+    else:
+        logging.info("Booting webdriver...")
+        driver = get_driver(args)
+        try:
             logging.info("Getting latest dashboard data...")
             data = get_dashboard_data(driver, URL_SCC_NOVCOVID_DASH)
-    except WebDriverException:
-        dump_doc(driver, "final.html")
-        driver.save_screenshot("final.png")
-        raise
-    finally:
-        driver.quit()
+        except WebDriverException:
+            dump_doc(driver, "final.html")
+            driver.save_screenshot("final.png")
+            raise
+        finally:
+            driver.quit()
 
     logging.info("%d rows of data retrieved!", len(data))
     if len(data) > 0:
@@ -283,6 +321,9 @@ def main():
             field_names = get_field_names(data)
             data = normalize_table_data(data, field_names)
             write_data_to_csv(args.output, data, field_names)
+            if not failed and os.path.exists(checkpoint):
+                # a complete run; the next one starts afresh
+                os.remove(checkpoint)
         return 0
     return 1
 
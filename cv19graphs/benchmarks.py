@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of loading, querying and charting the county data, run against synthetic data so they work offline
+and at sizes beyond the real file.
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --output new.json --compare results.json
+
+Synthetic datasets are generated once per scale into --data-dir and reused.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from cv19graphs import ca_data_parser
+
+# synthetic data at scale 1 is shaped like the real file by late 2020: 3,200 places over 300 days, ~635k rows
+BASE_COUNTIES = 3200
+BASE_DAYS = 300
+STATES = 55
+DEFAULT_SCALES = [1, 10]
+# relative slowdown of a benchmark's median that counts as a regression, and the smallest absolute one
+REGRESSION_THRESHOLD = 0.25
+REGRESSION_MIN_SECONDS = 0.0001
+
+
+def make_lines(counties, days=300, seed=0):
+    """
+    Synthetic cumulative case series shaped like the real ones.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2020-03-01", periods=days)
+    return [(f"County {i},State", dates, rng.integers(0, 50 + i, days).cumsum().astype("float64"))
+            for i in range(counties)]
+
+
+def write_counties_csv(filename, pops_filename, counties, days=BASE_DAYS, seed=0):
+    """
+    Write a deterministic synthetic us-counties.csv and matching county populations.
+    Like the real file, rows are sorted by date then state and county, places appear on staggered dates and
+    only ever grow but for the odd correction, and each state has an "Unknown" place with no fips.
+    :return: number of rows written
+    """
+    rng = np.random.default_rng(seed)
+    index = np.arange(counties)
+    state = index * STATES // counties
+    # the last place of each state is its unknowns, which sort last as they do in the real data
+    unknown = np.append(state[1:] != state[:-1], True)
+    state_names = np.array([f"State {s:02d}" for s in range(STATES)])[state]
+    county_names = np.where(unknown, "Unknown", np.char.add("County ", np.char.zfill(index.astype(str), 6)))
+    fips = np.where(unknown, "", (1000 + index).astype(str))
+    start = rng.integers(0, days * 2 // 3, counties)
+    start[0] = 0
+    daily_rate = rng.lognormal(1.0, 1.2, counties)
+    death_rate = rng.uniform(0.005, 0.03, counties)
+
+    cases = np.zeros(counties, dtype=np.int64)
+    deaths = np.zeros(counties, dtype=np.int64)
+    rows = 0
+    with open(filename, "w") as f:
+        f.write("date,county,state,fips,cases,deaths\n")
+        for day, date in enumerate(pd.date_range("2020-01-21", periods=days).strftime("%Y-%m-%d")):
+            active = np.flatnonzero(start <= day)
+            new_cases = rng.poisson(daily_rate[active] * (1 + 2 * day / days))
+            cases[active] += new_cases
+            deaths[active] += rng.binomial(new_cases, death_rate[active])
+            corrected = active[rng.random(len(active)) < 0.002]
+            cases[corrected] -= np.minimum(cases[corrected] // 10, 5)
+            pd.DataFrame({"date": date,
+                          "county": county_names[active],
+                          "state": state_names[active],
+                          "fips": fips[active],
+                          "cases": cases[active],
+                          "deaths": deaths[active]}).to_csv(f, header=False, index=False)
+            rows += len(active)
+    population = rng.lognormal(10.5, 1.5, counties).astype(np.int64) + 1000
+    pd.DataFrame({"state": state_names[~unknown],
+                  "county": county_names[~unknown],
+                  "population": population[~unknown]}).to_csv(pops_filename, index=False)
+    return rows
+
+
+def get_dataset_files(data_dir, scale, seed=0):
+    """
+    :return: us-counties.csv and populations filenames of the synthetic data at scale, generating them if needed
+    """
+    filename = os.path.join(data_dir, f"us-counties-{scale}x-{seed}.csv")
+    pops_filename = os.path.join(data_dir, f"countypops-{scale}x-{seed}.csv")
+    if not (os.path.exists(filename) and os.path.exists(pops_filename)):
+        os.makedirs(data_dir, exist_ok=True)
+        start = time.perf_counter()
+        # written under a temporary name, so an interrupted run doesn't leave a truncated file to be reused
+        rows = write_counties_csv(filename + ".tmp", pops_filename, BASE_COUNTIES * scale, seed=seed)
+        os.replace(filename + ".tmp", filename)
+        print(f"generated {rows} rows at {scale}x in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return filename, pops_filename
+
+
+def time_runs(func, repeat, warm_up=True):
+    if warm_up:
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def time_call(func, repeat):
+    return statistics.median(time_runs(func, repeat))
+
+
+def summarize(times):
+    return {"median": statistics.median(times), "min": min(times), "runs": len(times)}
+
+
+def bench_render_backends(repeat):
+    print(f"{'counties':>8} {'yscale':>7} " + " ".join(f"{b + ' ms':>10}" for b in ca_data_parser.RENDER_BACKENDS)
+          + f" {'speedup':>8}")
+    for counties in (1, 5, 10):
+        lines = make_lines(counties)
+        xticks = ca_data_parser.decimate_ticks(pd.Series(lines[0][1]))
+        for yscale in (None, "log"):
+            times = {}
+            for name, backend in ca_data_parser.RENDER_BACKENDS.items():
+                times[name] = time_call(lambda: backend(lines, "Title", "Total Cases", yscale, xticks, io.BytesIO()),
+                                        repeat)
+            print(f"{counties:>8} {yscale or 'linear':>7} "
+                  + " ".join(f"{t * 1000:>10.2f}" for t in times.values())
+                  + f" {times['agg'] / times['raster']:>7.1f}x")
+
+
+def bench_dataset(filename, pops_filename, repeat, load_repeat):
+    """
+    Time loading the data at filename, and querying and charting it.
+    :return: timings of each benchmark by name
+    """
+    results = {}
+    snapshot_dir = filename + ca_data_parser.SNAPSHOT_SUFFIX
+
+    def load_cold():
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        ca_data_parser.reload_us_counties(filename, pops_filename, incremental=False)
+
+    # parse the csv and build the snapshot, then load that as a restarted server would
+    results["reload_cold"] = summarize(time_runs(load_cold, load_repeat, warm_up=False))
+    results["reload_snapshot"] = summarize(time_runs(
+        lambda: ca_data_parser.reload_us_counties(filename, pops_filename, incremental=False), load_repeat,
+        warm_up=False))
+    data = ca_data_parser.dataset
+    results["rows"] = len(data.counties)
+
+    all_fips = data.matrices.fips[data.matrices.fips != ca_data_parser.NO_FIPS]
+    for n in (1, 10):
+        counties = [int(f) for f in all_fips[np.linspace(0, len(all_fips) - 1, n).astype(int)]]
+        dfs = ca_data_parser.get_county_data(counties, data)
+        block = ca_data_parser.get_county_block(counties, data)
+        start = ca_data_parser.find_chart_start(block)
+        daterange = pd.Series(block.dates[start:])
+        benches = {
+            "get_county_data": lambda: ca_data_parser.get_county_data(counties, data),
+            "get_county_block": lambda: ca_data_parser.get_county_block(counties, data),
+            "find_chart_start": lambda: ca_data_parser.find_chart_start(block),
+            "combine_date_ranges": lambda: ca_data_parser.combine_date_ranges(dfs),
+            "decimate_ticks": lambda: ca_data_parser.decimate_ticks(daterange),
+        }
+        for backend in ca_data_parser.RENDER_BACKENDS:
+            benches[f"plot_counties_{backend}"] = \
+                lambda backend=backend: ca_data_parser.plot_counties(block, "cases", io.BytesIO(), backend)
+        for name, func in benches.items():
+            results[f"{name}/{n}"] = summarize(time_runs(func, repeat))
+    return results
+
+
+def find_regressions(baseline, results, threshold=REGRESSION_THRESHOLD):
+    """
+    :param baseline: "benchmarks" of an earlier run's json output
+    :param results: "benchmarks" of this run
+    :return: (name, baseline median, median) of each benchmark that got slower by more than threshold
+    """
+    regressions = []
+    for name, timing in results.items():
+        old = baseline.get(name)
+        if not isinstance(timing, dict) or not isinstance(old, dict):
+            continue
+        slowdown = timing["median"] - old["median"]
+        if slowdown > threshold * old["median"] and slowdown > REGRESSION_MIN_SECONDS:
+            regressions.append((name, old["median"], timing["median"]))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{'benchmark':<36} {'median ms':>10} {'min ms':>10}" + (f" {'baseline':>10} {'change':>7}" if baseline else ""))
+    for name, timing in results.items():
+        if not isinstance(timing, dict):
+            print(f"{name:<36} {timing:>10}")
+            continue
+        line = f"{name:<36} {timing['median'] * 1000:>10.3f} {timing['min'] * 1000:>10.3f}"
+        old = (baseline or {}).get(name)
+        if isinstance(old, dict):
+            line += f" {old['median'] * 1000:>10.3f} {timing['median'] / old['median'] - 1:>+7.0%}"
+        print(line)
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per measurement")
+    parser.add_argument("--load-repeat", type=int, default=3, help="timed runs of loading the data")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES,
+                        help=f"sizes of synthetic data to benchmark, as multiples of {BASE_COUNTIES} places over "
+                             f"{BASE_DAYS} days; loading peaks at about 150 MB of memory per multiple")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--data-dir", default="benchmark-data", help="where to keep generated data")
+    parser.add_argument("--output", help="file to write the results to as json")
+    parser.add_argument("--compare", help="json output of an earlier run to flag regressions against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="relative slowdown flagged as a regression")
+    parser.add_argument("--render-backends", action="store_true",
+                        help="only compare the render backends on in-memory data")
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    if args.render_backends:
+        bench_render_backends(args.repeat)
+        return 0
+
+    results = {}
+    for scale in args.scales:
+        filename, pops_filename = get_dataset_files(args.data_dir, scale, args.seed)
+        for name, timing in bench_dataset(filename, pops_filename, args.repeat, args.load_repeat).items():
+            results[f"{scale}x/{name}"] = timing
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["benchmarks"]
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"date": datetime.now().isoformat(timespec="seconds"),
+                       "python": platform.python_version(),
+                       "pandas": pd.__version__,
+                       "numpy": np.__version__,
+                       "machine": platform.platform(),
+                       "seed": args.seed,
+                       "repeat": args.repeat,
+                       "benchmarks": results}, f, indent=2)
+    if baseline is not None:
+        regressions = find_regressions(baseline, results, args.threshold)
+        for name, old, new in regressions:
+            print(f"REGRESSION {name}: {old * 1000:.3f} ms -> {new * 1000:.3f} ms", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
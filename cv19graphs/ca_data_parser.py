@@ -1,12 +1,17 @@
+import io
 import logging
 import math
+import os
+import threading
 import time
 from datetime import datetime, timedelta
-from typing import Iterable, List, Optional
+from typing import BinaryIO, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
+from cv19graphs import metrics, raster, snapshot
 
 logger = logging.getLogger(__name__)
 NYC_COUNTY = "New York City"
@@ -33,18 +38,61 @@ CHARTS = {
         "ydata": "deaths_pc",
         "chart_title": "Deaths per Capita",
         "ylabel": "Deaths p/c"
-    }
+    },
+    "new_cases_7d": {"chart_title": "COVID19 New Cases (7-day average)",
+                     "ylabel": "New Cases, 7-day average"},
+    "new_deaths_7d": {"chart_title": "COVID19 New Deaths (7-day average)",
+                      "ylabel": "New Deaths, 7-day average"},
+    "incidence_7d": {"chart_title": "COVID19 7-day Incidence",
+                     "ylabel": "New Cases per 100k, last 7 days"},
+    "doubling_time": {"chart_title": "COVID19 Case Doubling Time",
+                      "yscale": "log",
+                      "ylabel": "Days to double (log scale)"},
+    "growth_wow": {"chart_title": "COVID19 Week-over-week Growth",
+                   "ylabel": "Change in weekly new cases (%)"}
 }
+# per capita columns, computed on demand from these columns and the county populations
+PER_CAPITA_COLUMNS = {"cases_pc": "cases", "deaths_pc": "deaths"}
 DEFAULT_CHART_TYPE = "cases"
 MAX_TICKS = 20
+US_COUNTIES_FILENAME = "us-counties.csv"
+COUNTYPOPS_FILENAME = "countypops.csv"
+SNAPSHOT_SUFFIX = ".snapshot"
+# bytes before the loaded end of us-counties.csv that must be unchanged to append to it
+APPEND_CHECK_BYTES = 4096
+# stand-in for a missing FIPS code in the compact fips column
+NO_FIPS = -1
+
+# the loaded data; replaced as a whole by reload_us_counties, never modified.  Not loaded at import.
+dataset: Optional["Dataset"] = None
+reload_lock = threading.Lock()
+
 
-us_counties = pd.DataFrame()
-latest_date = ""
+def build_county_index(counties: pd.DataFrame) -> Dict[int, Tuple[int, int]]:
+    """
+    Map each FIPS code to the contiguous row range holding its data.
+    :param counties: county data, sorted by fips then date
+    :return: dict of fips -> (start, stop) positional row range
+    """
+    fips = counties.fips.to_numpy()
+    if len(fips) == 0:
+        return {}
+    starts = np.flatnonzero(np.r_[True, fips[1:] != fips[:-1]])
+    stops = np.r_[starts[1:], len(fips)]
+    return {int(fips[start]): (int(start), int(stop))
+            for start, stop in zip(starts, stops)
+            if fips[start] != NO_FIPS}
 
 
-def reload_us_counties() -> None:
-    global us_counties, latest_date
-    counties = pd.read_csv("us-counties.csv",
+def read_counties_csv(f, names: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Parse NYT county rows.
+    :param f: filename or file object positioned at the rows to read
+    :param names: column names, when f is positioned past the header line
+    """
+    counties = pd.read_csv(f,
+                           header=None if names else "infer",
+                           names=names,
                            dtype={"county": "string",
                                   "state": "string",
                                   "fips": "Int32",
@@ -53,75 +101,457 @@ def reload_us_counties() -> None:
                            parse_dates=[0])
     # fix empty FIPS for NYC
     counties.loc[(counties.county == NYC_COUNTY) & (counties.fips.isnull()), 'fips'] = NYC_FIPS
+    return counties
+
+
+def read_county_populations(pops_filename: str) -> Dict[Tuple[str, str], int]:
+    countypops = pd.read_csv(pops_filename, dtype={"state": str, "county": str, "population": "int64"})
+    return {(state, county): population
+            for state, county, population in zip(countypops.state, countypops.county, countypops.population)}
+
 
+def compact_counties(counties: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert county rows to the compact in-memory layout: state and county as categoricals,
+    and fixed-width int32 columns with NO_FIPS for missing FIPS codes.
+    The snapshot stores the int32 columns together, so loading it maps them rather than merging them into
+    a private block.
+    """
+    compact = pd.DataFrame({"date": counties.date.to_numpy(),
+                            "state": pd.Categorical(counties.state.to_numpy(dtype=object)),
+                            "county": pd.Categorical(counties.county.to_numpy(dtype=object)),
+                            "fips": counties.fips.to_numpy(dtype="int32", na_value=NO_FIPS)})
+    for column in ["cases", "deaths", "new_cases", "new_deaths"]:
+        values = counties[column]
+        if values.hasnans:
+            # hold the previous total rather than dropping to 0
+            values = values.groupby([counties.state, counties.county], observed=True).ffill()
+        compact[column] = values.to_numpy(dtype="int32", na_value=0)
+    return compact
+
+
+def concat_counties(parts: List[pd.DataFrame]) -> pd.DataFrame:
+    # a plain concat would turn categoricals with different categories into object columns
+    categoricals = {column: union_categoricals([part[column] for part in parts])
+                    for column in ["state", "county"]}
+    combined = pd.concat(parts, ignore_index=True)
+    for column, values in categoricals.items():
+        combined[column] = values
+    return combined
+
+
+def add_derived_columns(counties: pd.DataFrame,
+                        last_cumulative: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Add the daily delta columns to date-ordered county rows.
+    :param counties: rows as returned by read_counties_csv
+    :param last_cumulative: state, county, cases, deaths of each county's last row already loaded,
+                            used to compute deltas for rows appended after it
+    :return: the rows in compact_counties layout
+    """
     # add "new_cases" computed column
-    deltas = counties.groupby(by=["state", "county"]).diff(axis=1).convert_dtypes().fillna(0)
-    counties["new_cases"] = deltas.cases
-    counties["new_deaths"] = deltas.deaths
+    keys = ["state", "county"]
+    values = counties[keys + ["cases", "deaths"]]
+    seed_rows = 0
+    if last_cumulative is not None:
+        seed_rows = len(last_cumulative)
+        values = pd.concat([last_cumulative.astype({"state": "string", "county": "string"}), values],
+                           ignore_index=True)
+    deltas = values.groupby(by=keys)[["cases", "deaths"]].diff().fillna(0).iloc[seed_rows:]
+    counties["new_cases"] = deltas.cases.array
+    counties["new_deaths"] = deltas.deaths.array
+    return compact_counties(counties)
+
+
+def parse_us_counties(filename: str) -> pd.DataFrame:
+    counties = add_derived_columns(read_counties_csv(filename))
+    # group each county's rows together (kept in date order) so lookups are a slice
+    counties.sort_values(["fips", "date"], kind="mergesort", inplace=True, ignore_index=True)
+    return counties
+
+
+def get_last_cumulative(counties: pd.DataFrame) -> pd.DataFrame:
+    # rows are in date order within each county, so the last row per county is its latest
+    return counties[["state", "county", "cases", "deaths"]] \
+        .drop_duplicates(["state", "county"], keep="last") \
+        .reset_index(drop=True)
+
+
+def read_source_state(filename: str, offset: int, sha1: Optional[str] = None) -> Dict:
+    """
+    Record how much of filename has been loaded, so later reloads can tell whether it was only appended to.
+    :param filename: NYT us-counties.csv
+    :param offset: number of bytes of filename that have been loaded
+    :param sha1: digest of those bytes, if already known (e.g. from the snapshot's source signature)
+    """
+    with open(filename, "rb") as f:
+        names = f.readline().decode().strip().split(",")
+        f.seek(max(0, offset - APPEND_CHECK_BYTES))
+        tail = f.read(offset - f.tell())
+    return {"filename": filename,
+            "names": names,
+            "offset": offset,
+            "tail": tail,
+            "sha1": sha1 if sha1 is not None else snapshot.file_digest(filename, offset)}
+
+
+def read_appended_rows(state: Dict) -> Optional[Tuple[pd.DataFrame, int]]:
+    """
+    Parse the rows appended to a source file since it was loaded.
+    :param state: as returned by read_source_state
+    :return: the new rows and the file offset they end at, or None if the file was changed in any
+             other way than appending whole rows
+    """
+    filename = state["filename"]
+    offset = state["offset"]
+    tail = state["tail"]
+    if not tail.endswith(b"\n"):
+        return None
+    with open(filename, "rb") as f:
+        # a cheap check of the rows just before the new ones first
+        f.seek(offset - len(tail))
+        if f.read(len(tail)) != tail:
+            return None
+        data = f.read()
+    # earlier rows may have been revised in place, e.g. by a full download after the NYT corrected history
+    if snapshot.file_digest(filename, offset) != state["sha1"]:
+        return None
+    # only consume complete lines, in case the file is still being written
+    data = data[:data.rfind(b"\n") + 1]
+    if not data:
+        return None
+    return read_counties_csv(io.BytesIO(data), names=state["names"]), offset + len(data)
+
+
+def append_us_counties(data: "Dataset", new_rows: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Extend the rows of data with rows dated after everything already loaded.
+    Only the new rows are parsed and diffed; their deltas continue from each county's last cumulative values.
+    :param data: dataset to extend
+    :param new_rows: rows as returned by read_counties_csv
+    :return: the combined rows, sorted like parse_us_counties, and their last cumulative values
+    """
+    new_rows = add_derived_columns(new_rows, data.last_cumulative)
+    last_cumulative = get_last_cumulative(concat_counties([data.last_cumulative, new_rows]))
+    new_rows.sort_values(["fips", "date"], kind="mergesort", inplace=True, ignore_index=True)
+    # both parts are already sorted, so a stable sort of the combined keys is a single merge pass
+    order = np.argsort(np.concatenate([data.counties.fips.to_numpy(), new_rows.fips.to_numpy()]), kind="stable")
+    combined = concat_counties([data.counties, new_rows])
+    return combined.take(order).reset_index(drop=True), last_cumulative
+
+
+class CountyBlock(NamedTuple):
+    """
+    Data of several counties aligned on the union of their dates, one column per county.
+    """
+    fips: np.ndarray
+    # "county,state" of each county
+    labels: List[str]
+    # union of the counties' dates, ascending; the data is daily, so this is a run of consecutive days
+    dates: np.ndarray
+    # dates x counties, whether the county has a row for the date
+    present: np.ndarray
+    # population of each county, NaN if unknown
+    population: np.ndarray
+    # column -> dates x counties array, NaN where the county has no value
+    values: Dict[str, np.ndarray]
+
+
+COUNT_COLUMNS = ["cases", "deaths", "new_cases", "new_deaths"]
+ROLLING_DAYS = 7
+INCIDENCE_PER = 100000
+
+
+def rolling_sum(values: np.ndarray, present: np.ndarray, days: int) -> np.ndarray:
+    """
+    Sum of each county's values over the last days dates, NaN unless it has a row for all of them.
+    """
+    sums = np.full(values.shape, np.nan)
+    if len(values) < days:
+        return sums
+    zero_row = np.zeros((1, values.shape[1]))
+    totals = np.vstack([zero_row, np.cumsum(np.where(present, values, 0), axis=0)])
+    counts = np.vstack([zero_row, np.cumsum(present, axis=0)])
+    window = totals[days:] - totals[:-days]
+    sums[days - 1:] = np.where(counts[days:] - counts[:-days] == days, window, np.nan)
+    return sums
+
+
+def shift(values: np.ndarray, days: int) -> np.ndarray:
+    shifted = np.full(values.shape, np.nan)
+    shifted[days:] = values[:-days]
+    return shifted
+
+
+def add_rolling_metrics(values: Dict[str, np.ndarray], present: np.ndarray, population: np.ndarray) -> None:
+    """
+    Add the smoothed and growth metric columns, computed from the count columns for all counties at once.
+    """
+    new_cases_week = rolling_sum(values["new_cases"], present, ROLLING_DAYS)
+    values["new_cases_7d"] = new_cases_week / ROLLING_DAYS
+    values["new_deaths_7d"] = rolling_sum(values["new_deaths"], present, ROLLING_DAYS) / ROLLING_DAYS
+    values["incidence_7d"] = new_cases_week / population * INCIDENCE_PER
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cases = values["cases"]
+        cases_week_ago = shift(cases, ROLLING_DAYS)
+        # days for cumulative cases to double at the past week's growth rate; undefined without growth
+        values["doubling_time"] = np.where((cases_week_ago > 0) & (cases > cases_week_ago),
+                                           ROLLING_DAYS * np.log(2) / np.log(cases / cases_week_ago),
+                                           np.nan)
+        new_cases_prior_week = shift(new_cases_week, ROLLING_DAYS)
+        values["growth_wow"] = np.where(new_cases_prior_week > 0,
+                                        (new_cases_week / new_cases_prior_week - 1) * 100,
+                                        np.nan)
+
+
+def add_per_capita(values: Dict[str, np.ndarray], population: np.ndarray) -> None:
+    for column, total in PER_CAPITA_COLUMNS.items():
+        values[column] = values[total] / population
+
+
+def build_county_block(rows: pd.DataFrame, lengths: np.ndarray,
+                       populations: Dict[Tuple[str, str], int]) -> CountyBlock:
+    """
+    Pivot county rows into dates x counties matrices of the count columns and the rolling metrics.
+    :param rows: rows of each county in turn, each county's in date order
+    :param lengths: number of rows of each county
+    :param populations: as returned by read_county_populations
+    """
+    county = np.repeat(np.arange(len(lengths)), lengths)
+    firsts = np.cumsum(lengths) - lengths
+    dates, date_rows = np.unique(rows.date.to_numpy(), return_inverse=True)
+    present = np.zeros((len(dates), len(lengths)), dtype=bool)
+    present[date_rows, county] = True
+    values = {}
+    for column in COUNT_COLUMNS:
+        block = np.full(present.shape, np.nan)
+        block[date_rows, county] = rows[column].to_numpy(dtype="float64", na_value=np.nan)
+        values[column] = block
+    states = rows.state.to_numpy()[firsts]
+    names = rows.county.to_numpy()[firsts]
+    population = np.array([populations.get((state, name), np.nan) for state, name in zip(states, names)],
+                          dtype="float64")
+    add_rolling_metrics(values, present, population)
+    return CountyBlock(fips=rows.fips.to_numpy()[firsts],
+                       labels=["{},{}".format(name, state) for name, state in zip(names, states)],
+                       dates=dates,
+                       present=present,
+                       population=population,
+                       values=values)
+
+
+def build_county_matrices(counties: pd.DataFrame, county_index: Dict[int, Tuple[int, int]],
+                          populations: Dict[Tuple[str, str], int]) -> CountyBlock:
+    """
+    Pivot the whole dataset into float32 dates x counties matrices, with counties in fips order.
+    Per capita columns are left out, as they're exact in float64 and cheap to compute per query.
+    :param counties: county data, sorted by fips then date
+    :param county_index: as returned by build_county_index
+    :param populations: as returned by read_county_populations
+    """
+    ranges = np.array(list(county_index.values()), dtype="int64").reshape(-1, 2)
+    # counties with a fips code are contiguous, after the rows without one
+    start = ranges[0, 0] if len(ranges) else len(counties)
+    block = build_county_block(counties.iloc[start:], ranges[:, 1] - ranges[:, 0], populations)
+    return block._replace(values={column: matrix.astype("float32") for column, matrix in block.values.items()})
+
+
+class Dataset(NamedTuple):
+    """
+    Everything loaded from the source files.  Readers should take a reference to dataset once and use it
+    throughout, so a concurrent reload can't change the data out from under them.
+    """
+    # incremented by each reload
+    version: int
+    # rows sorted by fips then date
+    counties: pd.DataFrame
+    # fips -> (start, stop) row range of that county's rows
+    county_index: Dict[int, Tuple[int, int]]
+    # the same data pivoted into dates x counties matrices; see build_county_matrices
+    matrices: CountyBlock
+    latest_date: str
+    # (state, county) -> population
+    populations: Dict[Tuple[str, str], int]
+    # state, county, cases, deaths as of each county's latest row, for computing deltas of appended rows
+    last_cumulative: pd.DataFrame
+    # what part of which source file the rows were loaded from; see read_source_state
+    source: Dict
+    # snapshot generation the data was loaded from, the same in every process that loads it; None if the
+    # snapshot couldn't be saved
+    generation: Optional[int]
+
+
+def matrices_to_arrays(matrices: CountyBlock) -> Dict[str, np.ndarray]:
+    arrays = {"fips": matrices.fips,
+              "labels": np.array(matrices.labels, dtype=str),
+              "dates": matrices.dates,
+              "present": matrices.present,
+              "population": matrices.population}
+    arrays.update({f"values.{column}": matrix for column, matrix in matrices.values.items()})
+    return arrays
+
 
-    #   add per capita columns
-    # load population column
-    countypops = pd.read_csv("countypops.csv",
-                             dtype={
-                                 "state": "string",
-                                 "county": "string",
-                                 "population": "Int64",
-                             })
-    countypops.set_index(["state", "county"], inplace=True)
-    counties.set_index(["state", "county"], inplace=True)
-    counties = counties.join(countypops)
-    counties.reset_index(inplace=True)
+def arrays_to_matrices(arrays: Dict[str, np.ndarray]) -> CountyBlock:
+    return CountyBlock(fips=arrays["fips"],
+                       labels=arrays["labels"],
+                       dates=arrays["dates"],
+                       present=arrays["present"],
+                       population=arrays["population"],
+                       values={name[len("values."):]: array for name, array in arrays.items()
+                               if name.startswith("values.")})
 
-    counties["cases_pc"] = counties.cases / counties.population
-    counties["deaths_pc"] = counties.deaths / counties.population
 
-    latest_date = counties.date.tail(1).dt.strftime("%Y-%m-%d").values[0]
-    us_counties = counties
+def load_dataset(filename: str = US_COUNTIES_FILENAME,
+                 pops_filename: str = COUNTYPOPS_FILENAME,
+                 previous: Optional[Dataset] = None,
+                 version: int = 1) -> Dataset:
+    """
+    Load the county dataset from its snapshot, if one matches the source files.  Otherwise build it, by
+    parsing only the rows appended to filename since previous was loaded if possible, and publish it as a
+    new snapshot generation.
+    The data is always served from the memory-mapped snapshot, so several processes loading the same source
+    files share one copy of it, and only one of them does the work of building it.
+    :param filename: NYT us-counties.csv
+    :param pops_filename: county population csv
+    :param previous: dataset to append to, if possible
+    :param version: version number of the new dataset
+    """
+    sources = [filename, pops_filename]
+    snapshot_dir = filename + SNAPSHOT_SUFFIX
+    with snapshot.locked(snapshot_dir):
+        snap = snapshot.load(snapshot_dir, sources)
+        if snap is not None:
+            logger.info("Loaded snapshot %s generation %d", snapshot_dir, snap.generation)
+        else:
+            appended = None
+            if previous is not None and previous.source["filename"] == filename:
+                appended = read_appended_rows(previous.source)
+            if appended is not None:
+                new_rows, offset = appended
+                logger.info("Appending %d new rows from %s", len(new_rows), filename)
+                counties, last_cumulative = append_us_counties(previous, new_rows)
+            else:
+                offset = os.stat(filename).st_size
+                counties = parse_us_counties(filename)
+                last_cumulative = get_last_cumulative(counties)
+            county_index = build_county_index(counties)
+            populations = read_county_populations(pops_filename)
+            matrices = build_county_matrices(counties, county_index, populations)
+            try:
+                generation = snapshot.save(snapshot_dir, counties, sources, matrices_to_arrays(matrices),
+                                           {filename: offset})
+                logger.info("Saved snapshot %s generation %d", snapshot_dir, generation)
+                # switch to the shared copy
+                snap = snapshot.load(snapshot_dir, sources)
+            except OSError as e:
+                logger.warning("Failed to save snapshot %s: %s", snapshot_dir, e)
+    sha1 = None
+    if snap is not None:
+        counties = snap.frame
+        # the size the snapshot was built from, in case the file has been appended to since
+        offset = snap.sources[filename]["size"]
+        sha1 = snap.sources[filename]["sha1"]
+        last_cumulative = get_last_cumulative(counties)
+        county_index = build_county_index(counties)
+        populations = read_county_populations(pops_filename)
+        matrices = arrays_to_matrices(snap.arrays)
+
+    return Dataset(version=version,
+                   counties=counties,
+                   county_index=county_index,
+                   matrices=matrices,
+                   latest_date=counties.date.max().strftime("%Y-%m-%d"),
+                   populations=populations,
+                   last_cumulative=last_cumulative,
+                   source=read_source_state(filename, offset, sha1),
+                   generation=snap.generation if snap is not None else None)
 
 
-logger.info("Loading covid-19 data by county...")
-start_load = time.time()
-reload_us_counties()
-end_load = time.time()
-logger.info("Done.  Took %.3f seconds", end_load-start_load)
+def reload_us_counties(filename: str = US_COUNTIES_FILENAME,
+                       pops_filename: str = COUNTYPOPS_FILENAME,
+                       incremental: bool = True) -> Dataset:
+    """
+    Load a new dataset (see load_dataset) and make it the current one.
+    :param filename: NYT us-counties.csv
+    :param pops_filename: county population csv
+    :param incremental: allow appending new rows to the current dataset
+    :return: the new dataset
+    """
+    global dataset
+    logger.info("Loading covid-19 data by county...")
+    start_load = time.time()
+    with reload_lock:
+        previous = dataset
+        version = previous.version + 1 if previous is not None else 1
+        dataset = load_dataset(filename, pops_filename, previous if incremental else None, version)
+    logger.info("Done.  Took %.3f seconds", time.time() - start_load)
+    return dataset
 
 
 class NoDataAvailableException(BaseException):
     pass
 
 
-def get_county_data(counties: Iterable[int]) -> List[pd.DataFrame]:
-    assert not us_counties.empty
+def get_county_data(counties: Iterable[int], data: Optional[Dataset] = None) -> List[pd.DataFrame]:
+    if data is None:
+        data = dataset
+    assert data is not None
     dfs = []
     for fips in counties:
-        df = us_counties.loc[us_counties.fips == fips]
-        if df.empty:
+        rows = data.county_index.get(fips)
+        if rows is None:
             continue
-        dfs.append(df)
+        start, stop = rows
+        dfs.append(data.counties.iloc[start:stop])
     return dfs
 
 
-def find_min_nonzero_date(dfs: Iterable[pd.DataFrame], cutoff: int) -> Optional[pd.Timestamp]:
-    max_date = pd.Timestamp.max
-    max_df_date = pd.Timestamp.min
-    min_nonzero_date = max_date
-    for df in dfs:
-        df.sort_values('date')
-        max_df_date = max(max_df_date, df.date.max())
-        nonzero_cases = df[df.cases > cutoff]
-        if not nonzero_cases.empty:
-            min_nonzero_date = min(min_nonzero_date, nonzero_cases.head(1).date.values[0])
-    if min_nonzero_date != max_date and min_nonzero_date != max_df_date:
-        return min_nonzero_date
-    return None
+def get_county_block(counties: Iterable[int], data: Optional[Dataset] = None) -> Optional[CountyBlock]:
+    """
+    Query the data of several counties at once, as a gather of their columns from the dataset's matrices.
+    :param counties: fips codes; ones not in the data are skipped
+    :param data: dataset to query, the current one by default
+    :return: the counties' data, or None if none of them are in the data
+    """
+    if data is None:
+        data = dataset
+    assert data is not None
+    county_matrices = data.matrices
+    all_fips = county_matrices.fips
+    counties = np.fromiter(counties, dtype="int64")
+    columns = np.searchsorted(all_fips, counties).clip(max=max(len(all_fips) - 1, 0))
+    columns = columns[all_fips[columns] == counties]
+    if len(columns) == 0:
+        return None
+    # keep only the dates any of these counties have data for
+    rows = np.flatnonzero(county_matrices.present[:, columns].any(axis=1))
+    cells = np.ix_(rows, columns)
+    values = {column: matrix[cells].astype("float64") for column, matrix in county_matrices.values.items()}
+    population = county_matrices.population[columns]
+    add_per_capita(values, population)
+    return CountyBlock(fips=all_fips[columns],
+                       labels=[county_matrices.labels[i] for i in columns],
+                       dates=county_matrices.dates[rows],
+                       present=county_matrices.present[cells],
+                       population=population,
+                       values=values)
+
+
+def make_county_block(dfs: List[pd.DataFrame], data: Optional[Dataset] = None) -> CountyBlock:
+    """
+    :param dfs: county data as returned by get_county_data
+    :param data: dataset to take populations from, the current one by default
+    """
+    if data is None:
+        data = dataset
+    block = build_county_block(pd.concat(dfs, ignore_index=True), np.array([len(df) for df in dfs]),
+                               data.populations)
+    add_per_capita(block.values, block.population)
+    return block
 
 
 def combine_date_ranges(dfs: List[pd.DataFrame]) -> pd.Series:
-    dr = dfs[0].date
-    for df in dfs[1:]:
-        dr = dr.append(df.date)
-    dr = dr.sort_values().unique()
-    return pd.Series(dr)
+    return pd.Series(np.unique(np.concatenate([df.date.to_numpy() for df in dfs])))
 
 
 def decimate_ticks(daterange: pd.Series) -> List[datetime]:
@@ -149,54 +579,251 @@ def decimate_ticks(daterange: pd.Series) -> List[datetime]:
     return dateticks
 
 
-def plot_counties(dfs: List[pd.DataFrame], chart_type: str, filename: str) -> None:
-    plt.switch_backend('Agg')
-    plt.subplots()
-    ax = plt.figure().add_subplot()
-
+def get_chart(chart_type: Optional[str]) -> Tuple[str, Dict]:
     if not chart_type:
         chart_type = DEFAULT_CHART_TYPE
     if chart_type not in CHARTS:
         raise ValueError("Invalid chart type!")
-    chart = CHARTS[chart_type]
-    min_nonzero_date = find_min_nonzero_date(dfs, 5)
-    if not min_nonzero_date:
-        min_nonzero_date = find_min_nonzero_date(dfs, 1)
-    daterange = combine_date_ranges(dfs)
-
-    for df in dfs:
-        county = df.head(1).county.values[0]
-        state = df.head(1).state.values[0]
-
-        if min_nonzero_date:
-            date_truncated_df = df.loc[df.date >= min_nonzero_date]
-            daterange = daterange.loc[lambda d: d >= min_nonzero_date]
-        else:
-            date_truncated_df = df
-        date_truncated_df.set_index("date", inplace=True)
-        if "ydata" in chart:
-            ydata = chart["ydata"]
-        else:
-            ydata = chart_type
-        data = date_truncated_df[ydata].values
-        date = date_truncated_df.index
-        plt.gcf().autofmt_xdate()
-        ax.plot(date, data, label="{},{}".format(county, state))
-    plt.grid(True)
-    plt.legend()
-    if "chart_title" in chart:
-        chart_title = chart["chart_title"]
-    else:
-        chart_title = chart_type
-    plt.title(f"{chart_title}")
-    if "ylabel" in chart:
-        plt.ylabel(chart["ylabel"])
+    return chart_type, CHARTS[chart_type]
+
+
+def find_chart_start(block: CountyBlock) -> int:
+    """
+    Skip the leading days where the counties had no or only a handful of cases.
+    :return: index into block.dates of the first date to chart
+    """
+    cases = block.values["cases"]
+    for cutoff in (5, 1):
+        above = np.flatnonzero((cases > cutoff).any(axis=1))
+        # a start on the last date would leave nothing to chart
+        if len(above) and above[0] != len(block.dates) - 1:
+            return int(above[0])
+    return 0
+
+
+def get_chart_lines(block: CountyBlock, column: str, start: int) -> List[Tuple[str, pd.DatetimeIndex, np.ndarray]]:
+    """
+    :return: (label, dates, values) of each county from block.dates[start] on, skipping dates it has no row for
+    """
+    dates = block.dates[start:]
+    present = block.present[start:]
+    values = block.values[column][start:]
+    return [(label, pd.DatetimeIndex(dates[present[:, i]]), values[present[:, i], i])
+            for i, label in enumerate(block.labels)]
+
+
+def plot_lines_agg(lines: List[Tuple[str, pd.Index, np.ndarray]], title: str, ylabel: str, yscale: Optional[str],
+                   xticks: List[datetime], fname: Union[str, BinaryIO]) -> None:
+    """
+    Render a line chart to a png with matplotlib.
+    Uses its own Figure and Agg canvas rather than pyplot, so it holds no global state and is safe to call
+    from several threads at once.
+    :param lines: (label, dates, values) of each series
+    :param title: chart title
+    :param ylabel: y axis label
+    :param yscale: matplotlib scale of the y axis, None for linear
+    :param xticks: dates to put x ticks at
+    :param fname: filename or binary file object to write the png to
+    """
+    # imported on first use, so importing this module doesn't pay for matplotlib
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    try:
+        with metrics.stage("figure"):
+            ax = fig.add_subplot()
+            for label, date, data in lines:
+                fig.autofmt_xdate()
+                ax.plot(date, data, label=label)
+            decorate_axes_agg(ax, title, ylabel, yscale, xticks)
+
+        with metrics.stage("savefig"):
+            fig.savefig(fname, format="png")
+    finally:
+        # drop the axes and artists now rather than waiting for the cycle collector
+        fig.clear()
+
+
+def decorate_axes_agg(ax, title: str, ylabel: str, yscale: Optional[str], xticks: List[datetime]) -> None:
+    ax.grid(True)
+    ax.legend()
+    ax.set_title(f"{title}")
+    ax.set_ylabel(ylabel)
+    ax.set_xlabel("Date")
+    ax.set_xticks(xticks)
+    for label in ax.get_xticklabels():
+        label.set_rotation(90)
+    if yscale:
+        ax.set_yscale(yscale)
+
+
+def plot_charts_agg(charts: List[Tuple[List[Tuple[str, pd.Index, np.ndarray]], str, str, Optional[str]]],
+                    xticks: List[datetime], fname: Union[str, BinaryIO]) -> None:
+    """
+    Render several line charts over the same dates to one png with matplotlib, one above the other.
+    :param charts: (lines, title, ylabel, yscale) of each chart, as plot_lines_agg takes them
+    :param xticks: dates to put x ticks at
+    :param fname: filename or binary file object to write the png to
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    width, height = Figure().get_size_inches()
+    fig = Figure(figsize=(width, height * len(charts)))
+    FigureCanvasAgg(fig)
+    try:
+        with metrics.stage("figure"):
+            for i, (lines, title, ylabel, yscale) in enumerate(charts):
+                ax = fig.add_subplot(len(charts), 1, i + 1)
+                for label, date, data in lines:
+                    ax.plot(date, data, label=label)
+                decorate_axes_agg(ax, title, ylabel, yscale, xticks)
+            fig.tight_layout()
+        with metrics.stage("savefig"):
+            fig.savefig(fname, format="png")
+    finally:
+        fig.clear()
+
+
+RENDER_BACKENDS = {
+    "agg": plot_lines_agg,
+    "raster": raster.plot_lines,
+}
+# same backends, rendering several charts to one image
+COMBINED_RENDER_BACKENDS = {
+    "agg": plot_charts_agg,
+    "raster": raster.plot_charts,
+}
+DEFAULT_RENDER_BACKEND = "agg"
+# joins chart types into the chart type of a combined image, e.g. "cases+deaths"
+COMBINED_CHART_SEPARATOR = "+"
+
+
+def split_chart_type(chart_type: Optional[str]) -> List[str]:
+    """
+    :return: the chart types making up chart_type, which is a key of CHARTS or several joined by
+             COMBINED_CHART_SEPARATOR
+    :raises ValueError: if any of them is not a key of CHARTS
+    """
+    return [get_chart(part)[0] for part in (chart_type or DEFAULT_CHART_TYPE).split(COMBINED_CHART_SEPARATOR)]
+
+
+def get_chart_plots(block: CountyBlock, chart_type: str, start: int) -> List[Tuple]:
+    """
+    :param chart_type: as split_chart_type takes it
+    :param start: index into block.dates to start the charts at
+    :return: (lines, title, ylabel, yscale) of each chart making up chart_type
+    """
+    plots = []
+    for part in split_chart_type(chart_type):
+        chart = CHARTS[part]
+        plots.append((get_chart_lines(block, chart.get("ydata", part), start),
+                      chart.get("chart_title", part),
+                      chart.get("ylabel", part),
+                      chart.get("yscale")))
+    return plots
+
+
+def plot_charts(plots: List[Tuple], xticks: List[datetime], fname: Union[str, BinaryIO], backend: str) -> None:
+    if len(plots) > 1:
+        COMBINED_RENDER_BACKENDS[backend](plots, xticks, fname)
     else:
-        plt.ylabel(chart_type)
-    plt.xlabel("Date")
-    xtickrange = decimate_ticks(daterange)
-    plt.xticks(xtickrange, rotation=90)
-    if "yscale" in chart:
-        plt.yscale(chart['yscale'])
-
-    plt.savefig(filename)
+        RENDER_BACKENDS[backend](*plots[0], xticks, fname)
+
+
+def plot_counties(block: CountyBlock, chart_type: str, fname: Union[str, BinaryIO],
+                  backend: str = DEFAULT_RENDER_BACKEND) -> None:
+    """
+    Render a line chart of block to a png.
+    :param block: county data as returned by get_county_block
+    :param chart_type: key of CHARTS, or several joined by COMBINED_CHART_SEPARATOR for one image of them all
+    :param fname: filename or binary file object to write the png to
+    :param backend: key of RENDER_BACKENDS
+    """
+    if backend not in RENDER_BACKENDS:
+        raise ValueError("Invalid render backend!")
+    with metrics.stage("dates"):
+        start = find_chart_start(block)
+        xtickrange = decimate_ticks(pd.Series(block.dates[start:]))
+    with metrics.stage("lines"):
+        plots = get_chart_plots(block, chart_type, start)
+    plot_charts(plots, xtickrange, fname, backend)
+
+
+def get_chart_series(block: CountyBlock, chart_type: str) -> Dict:
+    """
+    Get the data plot_counties would draw, as compact columnar arrays.
+    Dates are given as day offsets from base_date, and the series start at the same date as the chart would.
+    :param block: county data as returned by get_county_block
+    :param chart_type: key of CHARTS
+    :return: dict of the chart's labels, suggested x ticks, and one entry per county of offsets and values
+    """
+    chart_type, chart = get_chart(chart_type)
+    ydata = chart.get("ydata", chart_type)
+    start = find_chart_start(block)
+    daterange = pd.Series(block.dates[start:])
+    base_date = daterange.iloc[0]
+
+    series = []
+    for fips, (label, dates, values) in zip(block.fips, get_chart_lines(block, ydata, start)):
+        if ydata in COUNT_COLUMNS:
+            values = [None if math.isnan(v) else int(v) for v in values]
+        else:
+            values = [None if math.isnan(v) else v for v in values]
+        series.append({"fips": int(fips),
+                       "label": label,
+                       "offsets": (dates - base_date).days.tolist(),
+                       "values": values})
+    base = base_date.date()
+    return {"chart": chart_type,
+            "title": chart.get("chart_title", chart_type),
+            "ylabel": chart.get("ylabel", chart_type),
+            "yscale": chart.get("yscale", "linear"),
+            "base_date": base.strftime("%Y-%m-%d"),
+            "ticks": [(tick - base).days for tick in decimate_ticks(daterange)],
+            "series": series}
+
+
+def render_chart(counties: Iterable[int], chart_type: str, backend: str = DEFAULT_RENDER_BACKEND,
+                 data: Optional[Dataset] = None) -> bytes:
+    """
+    Render a chart of counties to png data.
+    :param data: dataset to chart, the current one by default
+    :raises NoDataAvailableException: if none of the counties are in the data
+    """
+    with metrics.stage("block"):
+        block = get_county_block(counties, data)
+    if block is None:
+        raise NoDataAvailableException("No counties matched in data!")
+    buf = io.BytesIO()
+    plot_counties(block, chart_type, buf, backend)
+    return buf.getvalue()
+
+
+def render_charts(counties: Iterable[int], chart_types: List[str], backend: str = DEFAULT_RENDER_BACKEND,
+                  data: Optional[Dataset] = None) -> List[bytes]:
+    """
+    Render a chart of counties for each of chart_types to png data, gathering the county data only once.
+    :param data: dataset to chart, the current one by default
+    :raises NoDataAvailableException: if none of the counties are in the data
+    """
+    if backend not in RENDER_BACKENDS:
+        raise ValueError("Invalid render backend!")
+    with metrics.stage("block"):
+        block = get_county_block(counties, data)
+    if block is None:
+        raise NoDataAvailableException("No counties matched in data!")
+    # every chart starts at the same date, so the start and ticks only need finding once
+    with metrics.stage("dates"):
+        start = find_chart_start(block)
+        xtickrange = decimate_ticks(pd.Series(block.dates[start:]))
+    pngs = []
+    for chart_type in chart_types:
+        with metrics.stage("lines"):
+            plots = get_chart_plots(block, chart_type, start)
+        buf = io.BytesIO()
+        plot_charts(plots, xtickrange, buf, backend)
+        pngs.append(buf.getvalue())
+    return pngs
@@ -0,0 +1,71 @@
+import threading
+from collections import Counter, OrderedDict
+from typing import Hashable, List, Optional
+
+
+class ChartCache:
+    """
+    LRU cache of rendered chart images, bounded by both total size and entry count.
+    """
+
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                return None
+            self._entries.move_to_end(key)
+            return data
+
+    def put(self, key: Hashable, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes or len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class ChartPopularity:
+    """
+    Counts how often each chart is requested, independent of the data version, so the most popular charts can be
+    rendered ahead of time after the data changes.
+    """
+
+    def __init__(self, max_tracked: int):
+        self.max_tracked = max_tracked
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def record(self, key: Hashable) -> None:
+        with self._lock:
+            self._counts[key] += 1
+            if len(self._counts) > self.max_tracked:
+                # forget the long tail, keeping the more popular half
+                self._counts = Counter(dict(self._counts.most_common(self.max_tracked // 2)))
+
+    def most_common(self, n: int) -> List[Hashable]:
+        with self._lock:
+            return [key for key, _ in self._counts.most_common(n)]
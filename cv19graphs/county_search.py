@@ -0,0 +1,76 @@
+import re
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Tuple
+
+# match ranks, best first: the county's name starts with the query, then "state county" does,
+# then any later word of either does (e.g. "clara" or "york city")
+COUNTY_PREFIX, STATE_PREFIX, WORD_PREFIX = range(3)
+
+
+def normalize(text: str) -> str:
+    """
+    Lower case, with punctuation such as the " - " between state and county dropped.
+    """
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def word_suffixes(text: str) -> List[str]:
+    """
+    :return: text from the start of each word after the first, e.g. ["clara"] for "santa clara"
+    """
+    return [text[m.start() + 1:] for m in re.finditer(r" \w", text)]
+
+
+class CountySearch:
+    """
+    Prefix index of "State - County" place names for search as you type.  Each rank has a sorted list of
+    (key, place) pairs, so a lookup is a bisect to the first key starting with the query and a scan that stops
+    as soon as there are enough results.
+    """
+
+    def __init__(self, fips_county_mapping: Dict[str, int]):
+        self.fips_county_mapping = fips_county_mapping
+        keys = [[] for _ in range(WORD_PREFIX + 1)]
+        for place in fips_county_mapping:
+            state, _, county = place.partition(" - ")
+            county = normalize(county)
+            state_county = normalize(place)
+            keys[COUNTY_PREFIX].append((county, place))
+            keys[STATE_PREFIX].append((state_county, place))
+            for suffix in set(word_suffixes(county) + word_suffixes(state_county)):
+                keys[WORD_PREFIX].append((suffix, place))
+        self._keys = [sorted(k) for k in keys]
+        self._places_by_fips = {}
+        for place, fips in sorted(fips_county_mapping.items()):
+            self._places_by_fips.setdefault(fips, place)
+
+    def __len__(self):
+        return len(self.fips_county_mapping)
+
+    def _matches(self, keys: List[Tuple[str, str]], query: str) -> Iterable[str]:
+        for i in range(bisect_left(keys, (query,)), len(keys)):
+            key, place = keys[i]
+            if not key.startswith(query):
+                break
+            yield place
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, int]]:
+        """
+        :return: up to limit (place, fips) pairs whose names contain a word starting with query, best matches first
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        found = {}
+        for keys in self._keys:
+            for place in self._matches(keys, query):
+                if len(found) >= limit:
+                    return list(found.items())
+                found.setdefault(place, self.fips_county_mapping[place])
+        return list(found.items())
+
+    def lookup(self, fips_codes: Iterable[int]) -> List[Tuple[str, int]]:
+        """
+        :return: (place, fips) pairs for the known fips_codes
+        """
+        return [(self._places_by_fips[fips], fips) for fips in fips_codes if fips in self._places_by_fips]
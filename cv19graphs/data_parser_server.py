@@ -1,18 +1,48 @@
+import gzip
+import hashlib
 import json
 import os
 import signal
-import uuid
+import threading
+import time
+from concurrent.futures import TimeoutError
+from typing import NamedTuple, Optional
 
-from flask import Flask, jsonify, url_for
-from flask import render_template, request
+from flask import Flask, Response, g, jsonify, redirect, url_for
+from flask import render_template, request, stream_with_context
 from werkzeug.exceptions import abort
 
-from cv19graphs import ca_data_parser
+from cv19graphs import ca_data_parser, metrics
 from cv19graphs.ca_data_parser import NoDataAvailableException
-from cv19graphs.flaskgzip import gzipped
+from cv19graphs.chart_cache import ChartCache, ChartPopularity
+from cv19graphs.county_search import CountySearch
+from cv19graphs.flaskgzip import compress_responses
+from cv19graphs.graph_jobs import DONE, FAILED, PENDING, JobQueue, SingleFlight
+from cv19graphs.render_pool import RenderPool, RenderQueueFullException, StaleDataException
 
 app = Flask(__name__)
 
+# gzip level for compressible responses (json, html, static text), and the smallest worth compressing
+GZIP_LEVEL = int(os.environ.get("CV19_GZIP_LEVEL", 6))
+GZIP_MIN_SIZE = int(os.environ.get("CV19_GZIP_MIN_SIZE", 512))
+compress_responses(app, GZIP_LEVEL, GZIP_MIN_SIZE)
+
+REQUEST_SECONDS = metrics.Histogram("cv19_request_seconds", "Time to handle requests", ["endpoint"])
+REQUESTS = metrics.Counter("cv19_requests_total", "Requests handled", ["endpoint", "status"])
+RENDERS = metrics.Counter("cv19_renders_total", "Charts rendered", ["backend"])
+RENDERS_COALESCED = metrics.Counter("cv19_renders_coalesced_total",
+                                    "Charts taken from an identical render already in flight instead of rendered")
+GRAPH_JOBS = metrics.Counter("cv19_graph_jobs_total", "Async /graph requests", ["result"])
+GRAPH_JOBS_PENDING = metrics.Gauge("cv19_graph_jobs_pending", "Async /graph jobs queued or running")
+CHART_CACHE_LOOKUPS = metrics.Counter("cv19_chart_cache_lookups_total", "Chart cache lookups", ["result"])
+CHART_CACHE_BYTES = metrics.Gauge("cv19_chart_cache_bytes", "Size of the charts in the chart cache")
+CHART_CACHE_ENTRIES = metrics.Gauge("cv19_chart_cache_entries", "Charts in the chart cache")
+RELOADS = metrics.Counter("cv19_reloads_total", "Data loads and reloads", ["result"])
+RELOAD_SECONDS = metrics.Histogram("cv19_reload_seconds", "Time to load or reload the data",
+                                   buckets=(0.5, 1, 2.5, 5, 10, 25, 50, 100, 250))
+DATASET_ROWS = metrics.Gauge("cv19_dataset_rows", "Rows in the loaded dataset")
+DATASET_VERSION = metrics.Gauge("cv19_dataset_version", "Version of the loaded dataset, counting reloads")
+
 STATIC_FOLDER = os.path.join('static')
 
 
@@ -21,35 +51,358 @@ def load_fips_county_mapping(filename='fips_county_mapping.json'):
         return json.load(f)
 
 
-fips_county_mapping = load_fips_county_mapping()
+class IndexPage(NamedTuple):
+    """
+    index.html as rendered for one SiteData, ready to send as is.
+    """
+    etag: str
+    body: bytes
+    gzip_body: bytes
+
+
+def render_index_page(dataset):
+    with app.app_context():
+        html = render_template('index.html',
+                               max_counties=MAX_COUNTIES,
+                               latest_date=dataset.latest_date,
+                               chart_types=list(ca_data_parser.CHARTS.keys())).encode()
+    # mtime=0 so identical pages compress identically
+    return IndexPage(hashlib.sha1(html).hexdigest(), html, gzip.compress(html, mtime=0))
+
+
+class SiteData(NamedTuple):
+    """
+    The county dataset along with the counties the page offers, replaced together on reload.
+    Request handlers take site_data once and use that throughout, so a reload never changes the data
+    under a request that has already started.
+    """
+    dataset: ca_data_parser.Dataset
+    county_search: CountySearch
+    index_page: IndexPage
+
+
+# None until the first load finishes; see start_loading
+site_data: Optional[SiteData] = None
+# why the last load failed, if it did
+load_error: Optional[str] = None
+reload_requested = threading.Event()
+reloader = None
+reloader_lock = threading.Lock()
+# seconds clients should wait before retrying while the data is loading
+LOADING_RETRY_AFTER = 5
+# seconds before retrying a failed first load, doubling after each failure up to the max
+LOAD_RETRY_MIN_SECONDS = 1
+LOAD_RETRY_MAX_SECONDS = 60
+
+
+def reload_site_data():
+    """
+    Load the data and mapping afresh and swap them in.  Requests are served from the old ones until then.
+    """
+    global site_data, load_error
+    app.logger.info("Loading counties and mapping.")
+    start = time.perf_counter()
+    dataset = ca_data_parser.reload_us_counties()
+    county_search = CountySearch(load_fips_county_mapping())
+    previous, site_data = site_data, SiteData(dataset, county_search, render_index_page(dataset))
+    load_error = None
+    chart_cache.clear()
+    RELOAD_SECONDS.observe(time.perf_counter() - start)
+    RELOADS.inc(result="ok")
+    DATASET_ROWS.set(len(dataset.counties))
+    DATASET_VERSION.set(dataset.version)
+    # workers started before the first load load the data themselves.  Until the restart, old workers given
+    # renders of the new data reload it themselves (see render_pool.render_with_data)
+    if render_pool is not None and previous is not None:
+        render_pool.restart()
+    app.logger.info("Done.  version=%d, latest date=%s, counties in mapping=%d",
+                    dataset.version,
+                    dataset.latest_date,
+                    len(site_data.county_search))
+    start_prerender()
+
+
+def run_reloader():
+    global load_error
+    retry_seconds = LOAD_RETRY_MIN_SECONDS
+    while True:
+        reload_requested.wait()
+        # SIGHUPs arriving during a reload are coalesced into one more reload after it
+        reload_requested.clear()
+        try:
+            reload_site_data()
+        except Exception as e:
+            load_error = repr(e)
+            RELOADS.inc(result="error")
+            site = site_data
+            if site is None:
+                # e.g. started while the csv was being replaced; there's nothing to serve, so keep trying
+                app.logger.exception("Load failed, retrying in %ds", retry_seconds)
+                reload_requested.wait(retry_seconds)
+                retry_seconds = min(retry_seconds * 2, LOAD_RETRY_MAX_SECONDS)
+                reload_requested.set()
+            else:
+                app.logger.exception("Reload failed, still serving version %d", site.dataset.version)
+        else:
+            retry_seconds = LOAD_RETRY_MIN_SECONDS
+
+
+def start_loading():
+    """
+    Load the data and mapping on a background thread, or reload them if they're already loaded.
+    Until the first load finishes, /readyz and every data endpoint return 503.
+    """
+    start_reloader()
+    reload_requested.set()
+
+
+def start_reloader():
+    """
+    Start the thread that loads the data whenever reload_requested is set, if it isn't running yet.
+    """
+    global reloader
+    with reloader_lock:
+        if reloader is None:
+            reloader = threading.Thread(target=run_reloader, name="reloader", daemon=True)
+            reloader.start()
 
 
 def sighup_handler(signum, frame):
-    app.logger.info("SIGHUP received, reloading counties and mapping.")
-    ca_data_parser.reload_us_counties()
-    load_fips_county_mapping()
-    app.logger.info("Done.  latest date=%s, counties in mapping=%d",
-                    ca_data_parser.latest_date,
-                    len(fips_county_mapping.keys()))
+    # runs on the main thread, between whatever it was doing, so it must not take locks that thread may hold
+    # (as start_loading does); the reloader picks this up once it's running
+    reload_requested.set()
 
 
 signal.signal(signal.SIGHUP, sighup_handler)
 
 
-def render_graph(counties, chart):
+CHART_CACHE_MAX_BYTES = 64 * 1024 * 1024
+CHART_CACHE_MAX_ENTRIES = 1024
+# chart urls include the data's latest date, so browsers can keep them until the next daily update
+CHART_MAX_AGE = 60 * 60
+chart_cache = ChartCache(CHART_CACHE_MAX_BYTES, CHART_CACHE_MAX_ENTRIES)
+
+# distinct (chart, counties) combinations to keep request counts for
+CHART_POPULARITY_MAX_TRACKED = 10000
+# most requested charts to render ahead of time after each data reload
+PRERENDER_COUNT = int(os.environ.get("CV19_PRERENDER_COUNT", 50))
+chart_popularity = ChartPopularity(CHART_POPULARITY_MAX_TRACKED)
+
+# number of worker processes to render charts in; 0 renders in the request thread
+RENDER_WORKERS = int(os.environ.get("CV19_RENDER_WORKERS", 0))
+# renders queued or running at once before /graph starts returning 503
+RENDER_QUEUE_SIZE = int(os.environ.get("CV19_RENDER_QUEUE_SIZE", 32))
+RENDER_TIMEOUT = float(os.environ.get("CV19_RENDER_TIMEOUT", 30))
+RENDER_RETRY_AFTER = 5
+# key of ca_data_parser.RENDER_BACKENDS: "agg" (matplotlib) or "raster" (direct rasterizer)
+RENDER_BACKEND = os.environ.get("CV19_RENDER_BACKEND", ca_data_parser.DEFAULT_RENDER_BACKEND)
+render_pool = None
+render_pool_lock = threading.Lock()
+# renders in progress, for identical requests to wait for rather than render again
+render_flights = SingleFlight()
+
+# threads rendering the charts of async /graph requests, and how many of those may be queued or running at once
+GRAPH_JOB_WORKERS = int(os.environ.get("CV19_GRAPH_JOB_WORKERS", 2))
+GRAPH_JOB_QUEUE_SIZE = int(os.environ.get("CV19_GRAPH_JOB_QUEUE_SIZE", 256))
+# how long async jobs' results are kept for clients to collect
+GRAPH_JOB_KEEP_SECONDS = 10 * 60
+# longest a /jobs/<id> poll may wait for the job to finish, and the interval of keep-alives on its event stream
+MAX_JOB_WAIT = 30
+JOB_EVENTS_KEEPALIVE = 15
+graph_jobs = JobQueue(GRAPH_JOB_WORKERS, GRAPH_JOB_QUEUE_SIZE, GRAPH_JOB_KEEP_SECONDS)
+
+
+def get_render_pool():
+    """
+    Start the render pool, if configured, on first use.  Not done at import: spawned render workers can end up
+    importing this module too, and must not start pools of their own.  Call at startup to pre-warm the workers.
+    """
+    global render_pool
+    if RENDER_WORKERS > 0 and render_pool is None:
+        with render_pool_lock:
+            if render_pool is None:
+                render_pool = RenderPool(RENDER_WORKERS, RENDER_QUEUE_SIZE, RENDER_TIMEOUT)
+    return render_pool
+
+
+def chart_key(dataset, counties, chart):
+    if not chart:
+        chart = ca_data_parser.DEFAULT_CHART_TYPE
+    return dataset.latest_date, chart, tuple(sorted(set(counties)))
+
+
+def render_graph(dataset, counties, chart):
+    """
+    Render a chart of counties, or fetch it from chart_cache if it was already rendered for dataset.
+    :return: url key of the chart (see chart_url) and the png data
+    """
+    return render_graphs(dataset, counties, [chart])[0]
+
+
+def render_graphs(dataset, counties, charts):
+    """
+    Render several charts of the same counties, gathering their data once for all those not in chart_cache.
+    :return: url key (see chart_url) and png data of each chart
+    """
+    keys = [chart_key(dataset, counties, chart) for chart in charts]
+    counties = keys[0][2]
+    # the url key only has the date, which a reload of corrected data may not change
+    cache_keys = [(dataset.version, chart, counties) for _, chart, _ in keys]
+    with metrics.stage("cache"):
+        results = [chart_cache.get(cache_key) for cache_key in cache_keys]
+    missing = [i for i, data in enumerate(results) if data is None]
+    CHART_CACHE_LOOKUPS.inc(len(results) - len(missing), result="hit")
+    CHART_CACHE_LOOKUPS.inc(len(missing), result="miss")
+    if not missing:
+        return list(zip(keys, results))
+
+    missing_keys = [cache_keys[i] for i in missing]
+    # includes waiting for a worker, or for the same render by another request; the stages of the render itself
+    # are timed where they run
+    with metrics.stage("render"):
+        rendered, shared = render_flights.do((dataset.version, tuple(missing_keys)), render_missing, dataset,
+                                             missing_keys)
+    if shared:
+        RENDERS_COALESCED.inc(len(rendered))
+    for i, data in zip(missing, rendered):
+        results[i] = data
+    return list(zip(keys, results))
+
+
+def render_missing(dataset, cache_keys):
+    """
+    Render the charts of cache_keys, all of the same counties, into chart_cache.
+    :return: the png data of each
+    """
+    counties = cache_keys[0][2]
+    charts = [chart for _, chart, _ in cache_keys]
+    pool = get_render_pool()
+    rendered = None
+    # workers load the same snapshot generation as dataset; without one, there's no telling their data is the same
+    if pool is not None and dataset.generation is not None:
+        try:
+            rendered = pool.render_charts(counties, charts, RENDER_BACKEND, dataset.generation)
+        except StaleDataException as e:
+            # the data was reloaded since the request started; it still gets charts of the data it started with
+            app.logger.info("Rendering in the server: %s", e)
+    if rendered is None:
+        rendered = ca_data_parser.render_charts(counties, charts, RENDER_BACKEND, dataset)
+    RENDERS.inc(len(rendered), backend=RENDER_BACKEND)
+    for cache_key, data in zip(cache_keys, rendered):
+        chart_cache.put(cache_key, data)
+        app.logger.info("rendered chart %s (%d bytes)", cache_key, len(data))
+    return rendered
+
+
+def prerender_popular(n=PRERENDER_COUNT):
+    """
+    Render the n most requested charts into chart_cache for the current data, most popular first.
+    Stops early if the data is reloaded again meanwhile.
+    :return: number of charts rendered
+    """
     logger = app.logger
-    dfs = ca_data_parser.get_county_data(counties)
-    if not dfs:
-        raise NoDataAvailableException("No counties matched in data!")
-
-    filename = f"{uuid.uuid4()}.png"
-    full_filename = os.path.join(STATIC_FOLDER, filename)
-    ca_data_parser.plot_counties(dfs, chart, full_filename)
-    logger.info("rendered chart to %s", full_filename)
-    return filename
+    if site_data is None:
+        return 0
+    dataset = site_data.dataset
+    rendered = 0
+    for chart, counties in chart_popularity.most_common(n):
+        if site_data.dataset is not dataset:
+            logger.info("Data reloaded, abandoning pre-render for version %d", dataset.version)
+            break
+        try:
+            render_graph(dataset, counties, chart)
+        except (NoDataAvailableException, ValueError):
+            continue
+        except (RenderQueueFullException, TimeoutError) as e:
+            # requests take priority; whatever isn't warm yet renders on demand
+            logger.warning("Stopping pre-render: %r", e)
+            break
+        rendered += 1
+    logger.info("Pre-rendered %d popular charts for version %d", rendered, dataset.version)
+    return rendered
+
+
+def start_prerender():
+    if PRERENDER_COUNT > 0:
+        threading.Thread(target=prerender_popular, name="prerender", daemon=True).start()
+
+
+def chart_url(key):
+    version, chart, counties = key
+    return url_for("chart_image",
+                   version=version,
+                   chart=chart,
+                   counties=",".join(str(c) for c in counties))
 
 
 MAX_COUNTIES = 10
+# charts in one /graphs request, or in one combined image
+MAX_BATCH_CHARTS = 8
+# /counties matches returned by default, and at most
+COUNTY_SEARCH_LIMIT = 20
+COUNTY_SEARCH_MAX_LIMIT = 100
+
+
+# endpoints that work before the data is loaded
+NO_DATA_ENDPOINTS = {"healthz", "readyz", "metrics", "static"}
+
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    g.stages = []
+    metrics.current_stages.set(g.stages)
+
+
+@app.after_request
+def finish_timing(response):
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "unknown"
+    REQUEST_SECONDS.observe(seconds, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    response.headers["Server-Timing"] = metrics.server_timing(g.stages + [("total", seconds)])
+    return response
+
+
+@app.teardown_request
+def stop_timing(_):
+    metrics.current_stages.set(None)
+
+
+@app.before_request
+def require_data():
+    """
+    Start loading the data on the first request, in case start_loading wasn't called at startup
+    (e.g. under a wsgi server importing app), and turn requests away until it's loaded.
+    """
+    if reloader is None:
+        start_loading()
+    if site_data is None and request.endpoint not in NO_DATA_ENDPOINTS:
+        return jsonify(error="Loading data, try again shortly."), 503, {"Retry-After": LOADING_RETRY_AFTER}
+
+
+@app.route('/healthz')
+def healthz():
+    return jsonify(status="ok")
+
+
+@app.route('/readyz')
+def readyz():
+    site = site_data
+    if site is None:
+        return jsonify(status="loading", error=load_error), 503, {"Retry-After": LOADING_RETRY_AFTER}
+    return jsonify(status="ready",
+                   version=site.dataset.version,
+                   latest_date=site.dataset.latest_date,
+                   error=load_error)
+
+
+@app.route('/metrics', endpoint="metrics")
+def handle_metrics():
+    CHART_CACHE_BYTES.set(chart_cache.size)
+    CHART_CACHE_ENTRIES.set(len(chart_cache))
+    GRAPH_JOBS_PENDING.set(graph_jobs.pending)
+    return Response(metrics.expose_all(), content_type=metrics.CONTENT_TYPE)
 
 
 @app.errorhandler(413)
@@ -57,6 +410,18 @@ def request_too_large(e):
     return jsonify(error=f"Too many counties (max {MAX_COUNTIES})"), 413
 
 
+@app.errorhandler(RenderQueueFullException)
+def render_queue_full(e):
+    app.logger.warning("Render queue full: %s", e)
+    return jsonify(error="Server busy, try again shortly."), 503, {"Retry-After": RENDER_RETRY_AFTER}
+
+
+@app.errorhandler(TimeoutError)
+def render_timeout(e):
+    app.logger.warning("Render timed out after %.1fs", RENDER_TIMEOUT)
+    return jsonify(error="Timed out rendering chart."), 504
+
+
 @app.errorhandler(400)
 def bad_request(e):
     return jsonify(error=f"Invalid request parameters specified."), 400
@@ -79,8 +444,21 @@ def get_counties(req_json):
     return counties
 
 
-@app.route('/graph', methods=['POST'])
-def handle_graph():
+def valid_chart_type(chart):
+    """
+    :return: whether chart is a chart type, or at most MAX_BATCH_CHARTS of them combined
+    """
+    try:
+        return len(ca_data_parser.split_chart_type(chart)) <= MAX_BATCH_CHARTS
+    except ValueError:
+        return False
+
+
+def get_graph_args():
+    """
+    Unpack and validate the counties and chart type of a /graph style request, aborting on invalid ones.
+    :return: (counties, chart), or None if no counties were requested
+    """
     if not request.json:
         return abort(400)
     logger = app.logger
@@ -95,6 +473,9 @@ def handle_graph():
         if type(chart) != str:
             logger.warning("Bad arg type (%s) for chart", type(chart))
             return abort(400)
+        if not valid_chart_type(chart):
+            logger.warning("Invalid chart type %.100s", chart)
+            return abort(400)
 
     logger.debug("chart type: %s", chart)
 
@@ -102,7 +483,7 @@ def handle_graph():
         return abort(413)
     if len(counties_arg) == 0:
         logger.warning("No counties in request?")
-        return "", 204
+        return None
 
     try:
         counties = get_counties(counties_arg)
@@ -110,27 +491,270 @@ def handle_graph():
     except TypeError as e:
         logger.warning("Invalid type encountered while unpacking json params: %s", e)
         return abort(400)
+    return counties, chart
+
+
+@app.route('/graph', methods=['POST'])
+def handle_graph():
+    logger = app.logger
+    with metrics.stage("parse"):
+        args = get_graph_args()
+    if args is None:
+        return "", 204
+    counties, chart = args
+    if request.json.get("async"):
+        return submit_graph_job(site_data.dataset, counties, chart)
 
     try:
-        filename = render_graph(counties, chart)
+        key, _ = render_graph(site_data.dataset, counties, chart)
     except NoDataAvailableException:
         logger.warning("No data found for specified counties.")
         return "", 204
+    except ValueError as e:
+        logger.warning("Failed to render chart: %s", e)
+        return abort(400)
+    chart_popularity.record(key[1:])
+
+    return jsonify({
+        "covid_graph": chart_url(key)
+    })
+
+
+def run_graph_job(dataset, counties, chart):
+    try:
+        key, _ = render_graph(dataset, counties, chart)
+    except JOB_ERRORS:
+        raise
+    except Exception:
+        # there's no request to turn into a 500 and log it
+        app.logger.exception("Graph job of %s %s failed", chart, counties)
+        raise
+    chart_popularity.record(key[1:])
+    return key
+
+
+def submit_graph_job(dataset, counties, chart):
+    """
+    Start rendering a chart in the background, or attach to the job already rendering the same one.
+    :return: 202 response with the job's id and url, see job_json
+    """
+    _, chart, counties = chart_key(dataset, counties, chart)
+    job, coalesced = graph_jobs.submit((dataset.version, chart, counties), run_graph_job, dataset, counties, chart)
+    GRAPH_JOBS.inc(result="coalesced" if coalesced else "started")
+    response = jsonify(job_json(job))
+    response.status_code = 202
+    response.location = url_for("job_status", job_id=job.id)
+    return response
+
+
+# error messages of jobs that failed, by exception type
+JOB_ERROR_MESSAGES = {NoDataAvailableException: "No data found for specified counties.",
+                      ValueError: "Invalid request parameters specified.",
+                      RenderQueueFullException: "Server busy, try again shortly.",
+                      TimeoutError: "Timed out rendering chart."}
+JOB_ERRORS = tuple(JOB_ERROR_MESSAGES)
+
+
+def job_json(job):
+    """
+    :return: the job's id, url and status, and once it's finished its chart url or error message
+    """
+    result = {"job": job.id, "job_url": url_for("job_status", job_id=job.id), "status": job.status}
+    if result["status"] == DONE:
+        result["covid_graph"] = chart_url(job.future.result())
+    elif result["status"] == FAILED:
+        e = job.future.exception()
+        result["error"] = next((message for error, message in JOB_ERROR_MESSAGES.items() if isinstance(e, error)),
+                               "Failed to render chart.")
+    return result
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Status of an async /graph job, see job_json.  With wait=seconds, waits up to that long for it to finish.
+    """
+    job = graph_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown or expired job."), 404
+    wait = request.args.get("wait", 0, type=float)
+    if wait > 0:
+        with metrics.stage("wait"):
+            job.wait(min(wait, MAX_JOB_WAIT))
+    response = jsonify(job_json(job))
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    Status of an async /graph job as server-sent events: one right away, then another once it finishes,
+    with comments in between to keep the connection open.
+    """
+    job = graph_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Unknown or expired job."), 404
+
+    def events():
+        yield f"data: {json.dumps(job_json(job))}\n\n"
+        if job.status != PENDING:
+            return
+        while not job.wait(JOB_EVENTS_KEEPALIVE):
+            yield ": keep-alive\n\n"
+        yield f"data: {json.dumps(job_json(job))}\n\n"
+
+    response = Response(stream_with_context(events()), mimetype="text/event-stream")
+    response.cache_control.no_store = True
+    return response
+
+
+def get_batch_charts():
+    """
+    Validate the charts of a /graphs request, aborting on invalid ones.
+    :return: chart types to render; a single combined one if "combined" was requested
+    """
+    charts = request.json.get("charts")
+    if (type(charts) is not list or not 0 < len(charts) <= MAX_BATCH_CHARTS or
+            any(type(chart) is not str for chart in charts)):
+        return abort(400)
+    try:
+        parts = [part for chart in charts for part in ca_data_parser.split_chart_type(chart)]
+    except ValueError:
+        return abort(400)
+    if len(parts) > MAX_BATCH_CHARTS:
+        return abort(400)
+    if request.json.get("combined"):
+        return [ca_data_parser.COMBINED_CHART_SEPARATOR.join(parts)]
+    # duplicates would only be rendered twice
+    return list(dict.fromkeys(charts))
+
+
+@app.route('/graphs', methods=['POST'])
+def handle_graphs():
+    """
+    Several charts of the same counties at once, as separate images or, with "combined", as one image
+    of them stacked.  Takes "counties" like /graph, and a list of chart types as "charts".
+    """
+    logger = app.logger
+    with metrics.stage("parse"):
+        args = get_graph_args()
+        charts = get_batch_charts() if args is not None else None
+    if args is None:
+        return "", 204
+    counties, _ = args
 
+    try:
+        rendered = render_graphs(site_data.dataset, counties, charts)
+    except NoDataAvailableException:
+        logger.warning("No data found for specified counties.")
+        return "", 204
+    urls = {}
+    for chart, (key, _) in zip(charts, rendered):
+        chart_popularity.record(key[1:])
+        urls[chart] = chart_url(key)
     return jsonify({
-        "covid_graph": url_for("static", filename=filename)
+        "covid_graphs": urls
     })
 
 
+@app.route('/series', methods=['POST'])
+def handle_series():
+    """
+    Chart data as columnar json, for clients that draw charts themselves.
+    Takes the same parameters as /graph.
+    """
+    logger = app.logger
+    with metrics.stage("parse"):
+        args = get_graph_args()
+    if args is None:
+        return "", 204
+    counties, chart = args
+
+    dataset = site_data.dataset
+    with metrics.stage("block"):
+        block = ca_data_parser.get_county_block(counties, dataset)
+    if block is None:
+        logger.warning("No data found for specified counties.")
+        return "", 204
+    try:
+        with metrics.stage("series"):
+            series = ca_data_parser.get_chart_series(block, chart)
+    except ValueError as e:
+        logger.warning("Failed to get chart series: %s", e)
+        return abort(400)
+    series["latest_date"] = dataset.latest_date
+    return jsonify(series)
+
+
+@app.route('/counties')
+def handle_counties():
+    """
+    Places matching the q parameter, best first, or the places of the comma separated fips parameter.
+    """
+    county_search = site_data.county_search
+    if "fips" in request.args:
+        try:
+            fips_codes = get_counties(request.args["fips"].split(","))
+        except TypeError:
+            return abort(400)
+        places = county_search.lookup(fips_codes[:MAX_COUNTIES])
+    else:
+        limit = request.args.get("limit", COUNTY_SEARCH_LIMIT, type=int)
+        places = county_search.search(request.args.get("q", ""), min(max(limit, 0), COUNTY_SEARCH_MAX_LIMIT))
+    response = jsonify(counties=[{"place": place, "fips": fips} for place, fips in places])
+    # counties only change with a data update
+    response.cache_control.public = True
+    response.cache_control.max_age = CHART_MAX_AGE
+    return response
+
+
+@app.route('/charts/<version>/<chart>/<counties>.png')
+def chart_image(version, chart, counties):
+    if not valid_chart_type(chart):
+        return abort(404)
+    try:
+        counties = get_counties(counties.split(","))
+    except TypeError:
+        return abort(404)
+    if len(counties) > MAX_COUNTIES:
+        return abort(413)
+    dataset = site_data.dataset
+    if version != dataset.latest_date:
+        # the data has been updated since this url was handed out
+        return redirect(chart_url(chart_key(dataset, counties, chart)))
+
+    try:
+        _, data = render_graph(dataset, counties, chart)
+    except NoDataAvailableException:
+        return abort(404)
+    response = Response(data, mimetype="image/png")
+    response.cache_control.public = True
+    response.cache_control.max_age = CHART_MAX_AGE
+    return response
+
+
 @app.route('/')
-@gzipped
 def index():
-    return render_template('index.html',
-                           fips_county_mapping=fips_county_mapping,
-                           max_counties=MAX_COUNTIES,
-                           latest_date=ca_data_parser.latest_date,
-                           chart_types=list(ca_data_parser.CHARTS.keys()))
+    """
+    The page is rendered and compressed once per reload (see render_index_page); browsers revalidate it
+    with the ETag and get a 304 until the data changes.
+    """
+    page = site_data.index_page
+    if request.accept_encodings["gzip"] > 0:
+        response = Response(page.gzip_body, mimetype="text/html")
+        response.content_encoding = "gzip"
+        # each encoding is a different representation, so needs its own strong etag
+        response.set_etag(page.etag + "-gzip")
+    else:
+        response = Response(page.body, mimetype="text/html")
+        response.set_etag(page.etag)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 if __name__ == "__main__":
+    get_render_pool()
+    start_loading()
     app.run(host="0.0.0.0", port=5000)
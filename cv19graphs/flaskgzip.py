@@ -1,37 +1,72 @@
-import gzip, functools
-from io import BytesIO as IO
-from flask import after_this_request, request
-
-
-def gzipped(f):
-    @functools.wraps(f)
-    def view_func(*args, **kwargs):
-        @after_this_request
-        def zipper(response):
-            accept_encoding = request.headers.get('Accept-Encoding', '')
-
-            if 'gzip' not in accept_encoding.lower():
-                return response
-
-            response.direct_passthrough = False
-
-            if (response.status_code < 200 or
-                    response.status_code >= 300 or
-                    'Content-Encoding' in response.headers):
-                return response
-            gzip_buffer = IO()
-            gzip_file = gzip.GzipFile(mode='wb',
-                                      fileobj=gzip_buffer)
-            gzip_file.write(response.data)
-            gzip_file.close()
-
-            response.data = gzip_buffer.getvalue()
-            response.headers['Content-Encoding'] = 'gzip'
-            response.headers['Vary'] = 'Accept-Encoding'
-            response.headers['Content-Length'] = len(response.data)
+import zlib
+from flask import request
+from werkzeug.wsgi import ClosingIterator
 
+DEFAULT_LEVEL = 6
+# responses smaller than this aren't worth the cpu, or the gzip header and trailer
+DEFAULT_MIN_SIZE = 512
+# everything else (png charts in particular) is either already compressed or not worth trying
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/javascript", "application/xml", "image/svg+xml"}
+# events must reach the client as they're sent, not when the compressor has enough to emit
+STREAMING_MIMETYPES = {"text/event-stream"}
+
+
+def is_compressible(mimetype):
+    return (bool(mimetype) and mimetype not in STREAMING_MIMETYPES and
+            (mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMETYPES))
+
+
+def compress_chunks(chunks, level):
+    """
+    Gzip an iterable of bytes incrementally, yielding compressed data as it becomes available.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response, level=DEFAULT_LEVEL, min_size=DEFAULT_MIN_SIZE):
+    """
+    Gzip response for the current request if the client accepts it and it's worth it.
+    Streamed and file responses are compressed chunk by chunk as they're sent, rather than read into memory.
+    """
+    if (response.status_code != 200 or
+            'Content-Encoding' in response.headers or
+            not is_compressible(response.mimetype)):
+        return response
+    # varies whether or not this particular request gets it compressed
+    response.vary.add("Accept-Encoding")
+    if request.accept_encodings["gzip"] <= 0:
+        return response
+
+    if response.is_streamed or response.direct_passthrough:
+        if response.content_length is not None and response.content_length < min_size:
+            return response
+        original = response.response
+        response.response = ClosingIterator(compress_chunks(response.iter_encoded(), level),
+                                            getattr(original, "close", None))
+        response.direct_passthrough = False
+        del response.headers['Content-Length']
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
             return response
+        response.set_data(b"".join(compress_chunks([data], level)))
+    response.headers['Content-Encoding'] = 'gzip'
+    # the compressed body is a different representation; a weak etag still validates it against the original's
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
 
-        return f(*args, **kwargs)
 
-    return view_func
+def compress_responses(app, level=DEFAULT_LEVEL, min_size=DEFAULT_MIN_SIZE):
+    """
+    Gzip responses from every view of app, see compress_response.
+    """
+    @app.after_request
+    def compress(response):
+        return compress_response(response, level, min_size)
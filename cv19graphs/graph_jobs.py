@@ -0,0 +1,157 @@
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from typing import Dict, Hashable, Optional, Tuple
+
+from cv19graphs.render_pool import RenderQueueFullException
+
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class SingleFlight:
+    """
+    Makes at most one call per key at a time: callers asking for a key that is already being computed wait for
+    that call and share its result, or its exception, rather than making their own.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key: Hashable, fn, *args):
+        """
+        :return: result of fn(*args), and whether it came from another caller's call
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class GraphJob:
+    """
+    A call run in the background for a client to collect the result of later, by id.
+    """
+
+    def __init__(self, key: Hashable):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.created = time.monotonic()
+        self.future = Future()
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return PENDING
+        return FAILED if self.future.exception() is not None else DONE
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        """
+        :return: whether the job finished within timeout seconds
+        """
+        return bool(wait_futures([self.future], timeout).done)
+
+
+class JobQueue:
+    """
+    Runs jobs on a pool of threads, with at most max_pending queued or running at once.
+    A job submitted with the key of one still pending is that job rather than a new one, so identical requests
+    share one run.  Finished jobs are kept for keep_seconds for their clients to collect.
+    """
+
+    def __init__(self, workers: int, max_pending: int, keep_seconds: float):
+        self.max_pending = max_pending
+        self.keep_seconds = keep_seconds
+        self._slots = threading.BoundedSemaphore(max_pending)
+        # threads are only started as jobs are submitted
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="graph-job")
+        # by id, oldest first
+        self._jobs: Dict[str, GraphJob] = {}
+        self._pending: Dict[Hashable, GraphJob] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def get(self, job_id: str) -> Optional[GraphJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def submit(self, key: Hashable, fn, *args) -> Tuple[GraphJob, bool]:
+        """
+        Run fn(*args) as a job, unless a job with key is already pending.
+        :return: the job, and whether it was already pending
+        :raises RenderQueueFullException: if max_pending jobs are already queued or running
+        """
+        with self._lock:
+            self._expire()
+            job = self._pending.get(key)
+            if job is not None:
+                return job, True
+            if not self._slots.acquire(blocking=False):
+                raise RenderQueueFullException(f"{self.max_pending} jobs already pending")
+            job = GraphJob(key)
+            self._jobs[job.id] = job
+            self._pending[key] = job
+        try:
+            self._executor.submit(self._run, job, fn, args)
+        except BaseException:
+            with self._lock:
+                del self._jobs[job.id]
+                del self._pending[key]
+            self._slots.release()
+            raise
+        return job, False
+
+    def _run(self, job: GraphJob, fn, args) -> None:
+        try:
+            result = fn(*args)
+            exception = None
+        # not just Exception: NoDataAvailableException isn't one
+        except BaseException as e:
+            result, exception = None, e
+        # later submits of the key start a new job, from here on
+        with self._lock:
+            del self._pending[job.key]
+        self._slots.release()
+        if exception is not None:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(result)
+
+    def _expire(self) -> None:
+        cutoff = time.monotonic() - self.keep_seconds
+        for job_id, job in list(self._jobs.items()):
+            # jobs are kept for keep_seconds from submission; renders finish long before that
+            if job.created >= cutoff or not job.future.done():
+                break
+            del self._jobs[job_id]
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
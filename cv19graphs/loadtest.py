@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Load test of the graph server on synthetic data.
+
+Starts data_parser_server in a process of its own, on data from benchmarks.write_counties_csv, and has
+--concurrency clients request the index page and charts of a realistic mix of county sets for --duration
+seconds.  Reports throughput, latency percentiles and errors by request kind, and the server's memory over time.
+
+    python loadtest.py --concurrency 8 --duration 60 --output load.json
+    CV19_RENDER_WORKERS=4 python loadtest.py --concurrency 16
+
+Server settings (CV19_RENDER_WORKERS, CV19_RENDER_BACKEND, ...) are taken from the environment as usual.
+Use --url to load an already running server instead, and --pid to also follow its memory.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pandas as pd
+
+from cv19graphs import benchmarks, ca_data_parser
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_CODE = ("import sys\n"
+               "from cv19graphs import data_parser_server as server\n"
+               "server.get_render_pool()\n"
+               "server.start_loading()\n"
+               "server.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)\n")
+READY_TIMEOUT = 600
+REQUEST_TIMEOUT = 60
+# how many counties a chart is of, and how likely each is; most people look at one or a few
+SET_SIZES = [1, 2, 3, 5, 10]
+SET_SIZE_WEIGHTS = [0.5, 0.2, 0.15, 0.1, 0.05]
+# county popularity falls off like 1 / rank ** ZIPF_EXPONENT
+ZIPF_EXPONENT = 1.1
+CHART_WEIGHTS = {"cases": 0.4, "new_cases_7d": 0.2, "deaths": 0.15, "cases_per_capita": 0.1,
+                 "incidence_7d": 0.1, "cases_log": 0.05}
+PERCENTILES = [50, 95, 99]
+
+
+def prepare_workdir(workdir, filename, pops_filename):
+    """
+    Lay out what the server reads from its working directory: the data, populations and fips mapping.
+    :return: fips codes of the places in the data
+    """
+    os.makedirs(os.path.join(workdir, "static"), exist_ok=True)
+    os.symlink(os.path.abspath(filename), os.path.join(workdir, ca_data_parser.US_COUNTIES_FILENAME))
+    shutil.copy(pops_filename, os.path.join(workdir, ca_data_parser.COUNTYPOPS_FILENAME))
+    places = pd.read_csv(filename, usecols=["county", "state", "fips"]).dropna().drop_duplicates()
+    mapping = {f"{state} - {county}": int(fips)
+               for state, county, fips in zip(places.state, places.county, places.fips)}
+    with open(os.path.join(workdir, "static", "fips_county_mapping.json"), "w") as f:
+        json.dump(mapping, f)
+    return sorted(set(mapping.values()))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, port):
+    env = dict(os.environ, PYTHONPATH=PACKAGE_DIR)
+    return subprocess.Popen([sys.executable, "-c", SERVER_CODE, str(port)], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_ready(url, server=None, timeout=READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"server exited with status {server.returncode}")
+        try:
+            with urlopen(url + "/readyz", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (HTTPError, URLError, ConnectionError):
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"server at {url} not ready after {timeout}s")
+
+
+def process_tree_rss(pid):
+    """
+    :return: resident memory in bytes of pid and its descendants (e.g. render workers), or None if pid is gone
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # the command name field can contain spaces, the fields after it can't
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                rss = next(line for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            if current == pid:
+                return None
+            continue
+        total += int(rss.split()[1]) * 1024
+        pending.extend(children.get(current, []))
+    return total
+
+
+class RequestMix:
+    """
+    Draws requests the way the page's users make them: mostly charts of one or a few popular counties.
+    """
+
+    def __init__(self, fips, index_share, seed=0):
+        rng = random.Random(seed)
+        self.fips = list(fips)
+        rng.shuffle(self.fips)
+        self.county_weights = list(np.cumsum(1 / np.arange(1, len(self.fips) + 1) ** ZIPF_EXPONENT))
+        self.index_share = index_share
+
+    def next(self, rng):
+        """
+        :return: ("index", None) or ("graph", /graph request json)
+        """
+        if rng.random() < self.index_share:
+            return "index", None
+        size = rng.choices(SET_SIZES, SET_SIZE_WEIGHTS)[0]
+        counties = set()
+        while len(counties) < min(size, len(self.fips)):
+            counties.add(rng.choices(self.fips, cum_weights=self.county_weights)[0])
+        chart = rng.choices(list(CHART_WEIGHTS), list(CHART_WEIGHTS.values()))[0]
+        return "graph", {"counties": sorted(counties), "chart": chart}
+
+
+def timed_request(request):
+    """
+    :return: status and seconds taken, status 0 for connection errors and timeouts
+    """
+    start = time.perf_counter()
+    try:
+        with urlopen(request, timeout=REQUEST_TIMEOUT) as response:
+            body = response.read()
+            status = response.status
+    except HTTPError as e:
+        body, status = b"", e.code
+    except (URLError, ConnectionError, socket.timeout):
+        body, status = b"", 0
+    return status, time.perf_counter() - start, body
+
+
+def run_client(url, mix, stop, results, seed):
+    """
+    Make requests one after another until stop is set, appending (kind, start, seconds, status) to results.
+    A chart is fetched like the page does: a /graph post, then a get of the chart url it returns.
+    """
+    rng = random.Random(seed)
+    while not stop.is_set():
+        kind, body = mix.next(rng)
+        start = time.monotonic()
+        if kind == "index":
+            status, seconds, _ = timed_request(Request(url + "/", headers={"Accept-Encoding": "gzip"}))
+            results.append(("index", start, seconds, status))
+            continue
+        status, seconds, data = timed_request(Request(url + "/graph", data=json.dumps(body).encode(),
+                                                      headers={"Content-Type": "application/json"}))
+        results.append(("graph", start, seconds, status))
+        if status == 200:
+            chart_url = json.loads(data)["covid_graph"]
+            start = time.monotonic()
+            status, seconds, _ = timed_request(Request(url + chart_url))
+            results.append(("chart", start, seconds, status))
+
+
+def sample_memory(pid, stop, samples, interval):
+    while not stop.wait(interval):
+        samples.append((time.monotonic(), process_tree_rss(pid)))
+
+
+def summarize(results, samples, started, duration, warmup):
+    """
+    :param results: (kind, start, seconds, status) of each request
+    :param samples: (time, rss bytes) taken during the run
+    :return: report of the requests started after warmup
+    """
+    measured = [r for r in results if r[1] >= started + warmup]
+    elapsed = max(duration - warmup, 1e-9)
+    report = {"requests": len(measured), "throughput": len(measured) / elapsed, "kinds": {}}
+    for kind in sorted({r[0] for r in measured}):
+        rows = [r for r in measured if r[0] == kind]
+        seconds = np.array([r[2] for r in rows])
+        statuses = {}
+        for r in rows:
+            statuses[str(r[3])] = statuses.get(str(r[3]), 0) + 1
+        errors = sum(count for status, count in statuses.items() if not 200 <= int(status) < 400)
+        report["kinds"][kind] = {"requests": len(rows),
+                                 "throughput": len(rows) / elapsed,
+                                 "error_rate": errors / len(rows),
+                                 "statuses": statuses,
+                                 **{f"p{p}": float(np.percentile(seconds, p)) for p in PERCENTILES},
+                                 "max": float(seconds.max())}
+    errors = sum(k["error_rate"] * k["requests"] for k in report["kinds"].values())
+    report["error_rate"] = errors / len(measured) if measured else 0.0
+    timeline = []
+    previous = started
+    for t, rss in samples:
+        # requests finished since the previous sample, per second
+        done = sum(1 for r in results if previous < r[1] + r[2] <= t)
+        rate = done / (t - previous) if t > previous else 0.0
+        timeline.append({"t": round(t - started, 1), "rss_mib": rss / 2 ** 20 if rss else None, "rps": rate})
+        previous = t
+    report["timeline"] = timeline
+    return report
+
+
+def print_report(report):
+    print(f"{report['requests']} requests, {report['throughput']:.1f}/s, {report['error_rate']:.2%} errors")
+    print(f"{'kind':<8} {'requests':>8} {'per s':>7} {'errors':>7} "
+          + " ".join(f"{'p' + str(p) + ' ms':>9}" for p in PERCENTILES) + f" {'max ms':>9}")
+    for kind, k in report["kinds"].items():
+        print(f"{kind:<8} {k['requests']:>8} {k['throughput']:>7.1f} {k['error_rate']:>7.2%} "
+              + " ".join(f"{k['p' + str(p)] * 1000:>9.1f}" for p in PERCENTILES) + f" {k['max'] * 1000:>9.1f}")
+    if report["timeline"]:
+        print(f"{'t':>6} {'rss MiB':>8} {'req/s':>6}")
+        for sample in report["timeline"]:
+            rss = f"{sample['rss_mib']:.1f}" if sample["rss_mib"] is not None else "-"
+            print(f"{sample['t']:>6} {rss:>8} {sample['rps']:>6.1f}")
+
+
+def run_loadtest(url, fips, concurrency, duration, warmup=0.0, index_share=0.1, pid=None, sample_interval=1.0,
+                 seed=0):
+    """
+    Load the server at url, see the module docstring.
+    :param fips: counties to draw chart requests from
+    :param pid: server process to follow the memory of
+    :return: report, see summarize
+    """
+    mix = RequestMix(fips, index_share, seed)
+    stop = threading.Event()
+    results = []
+    samples = []
+    started = time.monotonic()
+    threads = [threading.Thread(target=run_client, args=(url, mix, stop, results, seed + i), daemon=True)
+               for i in range(concurrency)]
+    if pid is not None:
+        samples.append((started, process_tree_rss(pid)))
+        threads.append(threading.Thread(target=sample_memory, args=(pid, stop, samples, sample_interval),
+                                        daemon=True))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join(REQUEST_TIMEOUT)
+    return summarize(results, samples, started, duration, warmup)
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, default=8, help="clients making requests at once")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds at the start to leave out of the report")
+    parser.add_argument("--index-share", type=float, default=0.1, help="share of requests for the index page")
+    parser.add_argument("--scale", type=int, default=1,
+                        help=f"size of the synthetic data, in multiples of {benchmarks.BASE_COUNTIES} places")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data and the request mix")
+    parser.add_argument("--data-dir", default="benchmark-data", help="where to keep generated data")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between memory samples")
+    parser.add_argument("--url", help="load this server rather than starting one")
+    parser.add_argument("--pid", type=int, help="process id of the server at --url, to follow its memory")
+    parser.add_argument("--mapping", default=os.path.join("static", "fips_county_mapping.json"),
+                        help="fips mapping of the server at --url, to draw counties from")
+    parser.add_argument("--output", help="file to write the report to as json")
+    return parser
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    workdir = None
+    server = None
+    try:
+        if args.url:
+            url, pid = args.url.rstrip("/"), args.pid
+            with open(args.mapping) as f:
+                fips = sorted(set(json.load(f).values()))
+        else:
+            filename, pops_filename = benchmarks.get_dataset_files(args.data_dir, args.scale, args.seed)
+            workdir = tempfile.mkdtemp(prefix="cv19-loadtest-")
+            fips = prepare_workdir(workdir, filename, pops_filename)
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            server = start_server(workdir, port)
+            pid = server.pid
+        start = time.perf_counter()
+        wait_ready(url, server)
+        print(f"server ready in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+        report = run_loadtest(url, fips, args.concurrency, args.duration, args.warmup, args.index_share, pid,
+                              args.sample_interval, args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report["settings"] = {name: value for name, value in vars(args).items() if name != "output"}
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["requests"] == 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
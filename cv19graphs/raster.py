@@ -0,0 +1,437 @@
+"""
+Direct rasterizer for the simple multi-series line charts in ca_data_parser.CHARTS.
+
+Draws into a NumPy pixel buffer with the same layout, colors and scales the matplotlib Agg path produces, but
+without building a matplotlib figure.  Only glyph rasterization is borrowed from matplotlib's FreeType wrapper.
+"""
+import math
+import struct
+import threading
+import zlib
+from datetime import date
+from typing import BinaryIO, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from cv19graphs import metrics
+
+WIDTH = 640
+HEIGHT = 480
+DPI = 100
+# axes box in pixels, as matplotlib lays out a default figure after autofmt_xdate
+AXES_LEFT = 80
+AXES_RIGHT = 576
+AXES_TOP = 58
+AXES_BOTTOM = 384
+# fraction of the data range added on each side, like matplotlib's axes.xmargin/ymargin
+MARGIN = 0.05
+# matplotlib's default tab10 color cycle
+COLORS = [(0x1f, 0x77, 0xb4), (0xff, 0x7f, 0x0e), (0x2c, 0xa0, 0x2c), (0xd6, 0x27, 0x28), (0x94, 0x67, 0xbd),
+          (0x8c, 0x56, 0x4b), (0xe3, 0x77, 0xc2), (0x7f, 0x7f, 0x7f), (0xbc, 0xbd, 0x22), (0x17, 0xbe, 0xcf)]
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+GRID_COLOR = (0xb0, 0xb0, 0xb0)
+LEGEND_EDGE_COLOR = (0xcc, 0xcc, 0xcc)
+LINE_WIDTH = 2.0
+FONT_SIZE = 10
+TITLE_FONT_SIZE = 12
+EXPONENT_FONT_SIZE = 7
+TICK_LENGTH = 5
+MINOR_TICK_LENGTH = 3
+TICK_PAD = 5
+# above this many ticks' worth of magnitude, tick labels share a "1eN" multiplier like matplotlib's ScalarFormatter
+SCI_LIMITS = (-5, 6)
+# fast zlib level; the flat-colored charts still come out at a third of the size of Agg's pngs
+PNG_COMPRESSION = 1
+TEXT_CACHE_SIZE = 4096
+
+ChartLine = Tuple[str, np.ndarray, np.ndarray]
+
+_font = None
+_font_lock = threading.Lock()
+_text_cache = {}
+
+
+def render_text(text: str, size: float) -> np.ndarray:
+    """
+    Rasterize a line of text.
+    :return: coverage of each pixel by the text, from 0 to 1
+    """
+    global _font
+    key = (text, size)
+    with _font_lock:
+        alpha = _text_cache.get(key)
+        if alpha is not None:
+            return alpha
+        if _font is None:
+            # imported on first use, so importing this module doesn't pay for matplotlib
+            from matplotlib import font_manager, ft2font
+            _font = ft2font.FT2Font(font_manager.findfont(font_manager.FontProperties()))
+        _font.clear()
+        _font.set_size(size, DPI)
+        _font.set_text(text, 0.0)
+        _font.draw_glyphs_to_bitmap(antialiased=True)
+        alpha = np.asarray(_font.get_image(), dtype=np.float32) / 255
+        if len(_text_cache) >= TEXT_CACHE_SIZE:
+            _text_cache.clear()
+        _text_cache[key] = alpha
+        return alpha
+
+
+def blend(canvas: np.ndarray, alpha: np.ndarray, x: int, y: int, color: Sequence[int]) -> None:
+    """
+    Paint color onto canvas through alpha, with alpha's top left corner at (x, y), clipped to the canvas.
+    """
+    h, w = alpha.shape
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, canvas.shape[1]), min(y + h, canvas.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    a = alpha[y0 - y:y1 - y, x0 - x:x1 - x, None]
+    region = canvas[y0:y1, x0:x1]
+    region *= 1 - a
+    region += a * np.asarray(color, dtype=np.float32)
+
+
+def draw_text(canvas: np.ndarray, text: str, x: float, y: float, size: float = FONT_SIZE,
+              ha: str = "left", va: str = "top", rotated: bool = False, color: Sequence[int] = BLACK) -> Tuple[int, int]:
+    """
+    Draw text aligned to (x, y), optionally rotated 90 degrees counterclockwise.
+    :return: width and height of the drawn text
+    """
+    alpha = render_text(text, size)
+    if rotated:
+        alpha = np.rot90(alpha)
+    h, w = alpha.shape
+    x -= {"left": 0, "center": w / 2, "right": w}[ha]
+    y -= {"top": 0, "center": h / 2, "bottom": h}[va]
+    blend(canvas, alpha, int(round(x)), int(round(y)), color)
+    return w, h
+
+
+def fill_rect(canvas: np.ndarray, x0: float, y0: float, x1: float, y1: float, color: Sequence[int],
+              opacity: float = 1.0) -> None:
+    x0, y0, x1, y1 = (int(round(v)) for v in (x0, y0, x1, y1))
+    region = canvas[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)]
+    region *= 1 - opacity
+    region += opacity * np.asarray(color, dtype=np.float32)
+
+
+def stroke(canvas: np.ndarray, xs: np.ndarray, ys: np.ndarray, color: Sequence[int], width: float,
+           clip: Tuple[int, int, int, int]) -> None:
+    """
+    Draw an antialiased polyline through (xs, ys), in pixel coordinates, clipped to clip = (x0, y0, x1, y1).
+    All segments are sampled every half pixel at once, and the samples splatted bilinearly into a coverage buffer.
+    Points that are not finite break the line, like masked points in matplotlib.
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    if len(xs) == 1:
+        xs, ys = np.repeat(xs, 2), np.repeat(ys, 2)
+    valid = np.isfinite(xs) & np.isfinite(ys)
+    segments = valid[:-1] & valid[1:]
+    if not segments.any():
+        return
+    sx, sy = xs[:-1][segments], ys[:-1][segments]
+    dx, dy = xs[1:][segments] - sx, ys[1:][segments] - sy
+    length = np.hypot(dx, dy)
+    samples = np.ceil(length * 2).astype(np.int64) + 1
+    seg = np.repeat(np.arange(len(samples)), samples)
+    t = (np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)) \
+        / np.maximum(samples - 1, 1)[seg]
+    px = sx[seg] + t * dx[seg]
+    py = sy[seg] + t * dy[seg]
+    # offset copies along each segment's normal give the stroke its width
+    with np.errstate(invalid="ignore", divide="ignore"):
+        nx = np.where(length > 0, -dy / length, 0)[seg]
+        ny = np.where(length > 0, dx / length, 1)[seg]
+    offsets = np.linspace(-(width - 1) / 2, (width - 1) / 2, max(2, int(math.ceil(width * 2))))
+    px = (px + offsets[:, None] * nx).ravel()
+    py = (py + offsets[:, None] * ny).ravel()
+
+    # only the pixels the stroke can touch need a coverage buffer
+    x0 = max(clip[0], int(np.floor(np.nanmin(px))) - 1)
+    y0 = max(clip[1], int(np.floor(np.nanmin(py))) - 1)
+    x1 = min(clip[2], int(np.ceil(np.nanmax(px))) + 2)
+    y1 = min(clip[3], int(np.ceil(np.nanmax(py))) + 2)
+    if x0 >= x1 or y0 >= y1:
+        return
+    coverage = np.zeros((y1 - y0, x1 - x0), dtype=np.float32)
+    fx = px - x0 - 0.5
+    fy = py - y0 - 0.5
+    ix = np.floor(fx).astype(np.int64)
+    iy = np.floor(fy).astype(np.int64)
+    wx = (fx - ix).astype(np.float32)
+    wy = (fy - iy).astype(np.float32)
+    for ox, oy, weight in ((0, 0, (1 - wx) * (1 - wy)), (1, 0, wx * (1 - wy)),
+                           (0, 1, (1 - wx) * wy), (1, 1, wx * wy)):
+        cx, cy = ix + ox, iy + oy
+        inside = (cx >= 0) & (cx < x1 - x0) & (cy >= 0) & (cy < y1 - y0)
+        np.maximum.at(coverage, (cy[inside], cx[inside]), weight[inside])
+    cy, cx = np.nonzero(coverage)
+    alpha = np.minimum(coverage[cy, cx] * 1.5, 1)[:, None]
+    cy += y0
+    cx += x0
+    canvas[cy, cx] = canvas[cy, cx] * (1 - alpha) + alpha * np.asarray(color, dtype=np.float32)
+
+
+def nice_ticks(lo: float, hi: float, max_ticks: int = 9) -> np.ndarray:
+    """
+    Evenly spaced ticks at a "nice" step (1, 2, 2.5 or 5 times a power of ten) covering [lo, hi].
+    """
+    if hi <= lo:
+        hi = lo + 1
+    raw_step = (hi - lo) / (max_ticks - 1)
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = next(s * magnitude for s in (1, 2, 2.5, 5, 10) if s * magnitude >= raw_step)
+    first = math.ceil(lo / step - 1e-9)
+    last = math.floor(hi / step + 1e-9)
+    return np.arange(first, last + 1) * step
+
+
+def format_ticks(ticks: np.ndarray) -> Tuple[List[str], Optional[int]]:
+    """
+    Format linear axis tick values with a common number of decimals.
+    :return: labels, and the power of ten they are scaled by (None if unscaled)
+    """
+    exponent = None
+    largest = np.abs(ticks).max() if len(ticks) else 0
+    if largest > 0:
+        magnitude = math.floor(math.log10(largest))
+        if magnitude >= SCI_LIMITS[1] or magnitude <= SCI_LIMITS[0]:
+            exponent = magnitude
+            ticks = ticks / 10 ** exponent
+    # fewest decimals that show every tick exactly
+    decimals = next((d for d in range(10) if all(abs(round(t, d) - t) < 1e-9 * max(1, abs(t)) for t in ticks)), 10)
+    return [f"{t:.{decimals}f}".replace("-", "−") for t in ticks], exponent
+
+
+class Axis:
+    """
+    Maps data values to pixels along one axis, linearly or logarithmically.
+    """
+
+    def __init__(self, lo: float, hi: float, pixel_lo: float, pixel_hi: float, log: bool = False):
+        self.log = log
+        if log:
+            lo, hi = math.log10(lo), math.log10(hi)
+        if hi == lo:
+            lo, hi = lo - 0.5, hi + 0.5
+        span = hi - lo
+        self.lo = lo - span * MARGIN
+        self.hi = hi + span * MARGIN
+        self.pixel_lo = pixel_lo
+        self.pixel_hi = pixel_hi
+
+    def __call__(self, values) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float64)
+        if self.log:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = np.where(values > 0, np.log10(np.where(values > 0, values, 1)), np.nan)
+        return self.pixel_lo + (values - self.lo) / (self.hi - self.lo) * (self.pixel_hi - self.pixel_lo)
+
+    def view_limits(self) -> Tuple[float, float]:
+        if self.log:
+            return 10 ** self.lo, 10 ** self.hi
+        return self.lo, self.hi
+
+
+def draw_y_axis(canvas: np.ndarray, axis: Axis) -> int:
+    """
+    Draw y grid lines, ticks and tick labels.
+    :return: width of the widest tick label
+    """
+    lo, hi = axis.view_limits()
+    label_width = 0
+    if axis.log:
+        decades = np.arange(math.ceil(math.log10(lo) - 1e-9), math.floor(math.log10(hi) + 1e-9) + 1)
+        minor = np.array([m * 10.0 ** d for d in range(int(decades.min(initial=math.floor(math.log10(lo)))) - 1,
+                                                       int(decades.max(initial=math.ceil(math.log10(hi)))) + 1)
+                          for m in range(2, 10)])
+        for y in axis(minor[(minor >= lo) & (minor <= hi)]):
+            fill_rect(canvas, AXES_LEFT - MINOR_TICK_LENGTH, round(y), AXES_LEFT, round(y) + 1, BLACK)
+        for decade, y in zip(decades, axis(10.0 ** decades)):
+            y = round(y)
+            fill_rect(canvas, AXES_LEFT, y, AXES_RIGHT, y + 1, GRID_COLOR)
+            fill_rect(canvas, AXES_LEFT - TICK_LENGTH, y, AXES_LEFT, y + 1, BLACK)
+            # 10 with a superscript exponent
+            exp_w, _ = draw_text(canvas, str(int(decade)).replace("-", "−"), AXES_LEFT - TICK_LENGTH - TICK_PAD,
+                                 y - 2, size=EXPONENT_FONT_SIZE, ha="right", va="bottom")
+            base_w, _ = draw_text(canvas, "10", AXES_LEFT - TICK_LENGTH - TICK_PAD - exp_w, y, ha="right",
+                                  va="center")
+            label_width = max(label_width, base_w + exp_w)
+        return label_width
+
+    ticks = nice_ticks(lo, hi)
+    labels, exponent = format_ticks(ticks)
+    for label, y in zip(labels, axis(ticks)):
+        y = round(y)
+        fill_rect(canvas, AXES_LEFT, y, AXES_RIGHT, y + 1, GRID_COLOR)
+        fill_rect(canvas, AXES_LEFT - TICK_LENGTH, y, AXES_LEFT, y + 1, BLACK)
+        w, _ = draw_text(canvas, label, AXES_LEFT - TICK_LENGTH - TICK_PAD, y, ha="right", va="center")
+        label_width = max(label_width, w)
+    if exponent is not None:
+        draw_text(canvas, f"1e{exponent}", AXES_LEFT, AXES_TOP - 2, va="bottom")
+    return label_width
+
+
+def draw_legend(canvas: np.ndarray, entries: List[Tuple[str, Sequence[int]]],
+                points: List[Tuple[np.ndarray, np.ndarray]]) -> None:
+    """
+    Draw a legend box in whichever corner of the axes covers the fewest plotted points, like loc="best".
+    """
+    line_height = int(FONT_SIZE * DPI / 72 * 1.2)
+    handle_length = int(FONT_SIZE * DPI / 72 * 2)
+    pad = int(FONT_SIZE * DPI / 72 * 0.4)
+    gap = int(FONT_SIZE * DPI / 72 * 0.8)
+    text_width = max(render_text(label, FONT_SIZE).shape[1] for label, _ in entries)
+    width = pad + handle_length + gap + text_width + pad
+    height = pad + line_height * len(entries) + pad
+    inset = int(FONT_SIZE * DPI / 72 * 0.5)
+    corners = [(AXES_RIGHT - inset - width, AXES_TOP + inset),
+               (AXES_LEFT + inset, AXES_TOP + inset),
+               (AXES_LEFT + inset, AXES_BOTTOM - inset - height),
+               (AXES_RIGHT - inset - width, AXES_BOTTOM - inset - height)]
+
+    def covered(corner):
+        x0, y0 = corner
+        return sum(int(np.count_nonzero((xs >= x0) & (xs <= x0 + width) & (ys >= y0) & (ys <= y0 + height)))
+                   for xs, ys in points)
+
+    x0, y0 = min(corners, key=covered)
+    fill_rect(canvas, x0, y0, x0 + width, y0 + height, WHITE, opacity=0.8)
+    fill_rect(canvas, x0, y0, x0 + width, y0 + 1, LEGEND_EDGE_COLOR)
+    fill_rect(canvas, x0, y0 + height - 1, x0 + width, y0 + height, LEGEND_EDGE_COLOR)
+    fill_rect(canvas, x0, y0, x0 + 1, y0 + height, LEGEND_EDGE_COLOR)
+    fill_rect(canvas, x0 + width - 1, y0, x0 + width, y0 + height, LEGEND_EDGE_COLOR)
+    for i, (label, color) in enumerate(entries):
+        cy = y0 + pad + line_height * i + line_height / 2
+        stroke(canvas, np.array([x0 + pad, x0 + pad + handle_length]), np.array([cy, cy]), color, LINE_WIDTH,
+               (0, 0, WIDTH, HEIGHT))
+        draw_text(canvas, label, x0 + pad + handle_length + gap, cy, va="center")
+
+
+def encode_png(pixels: np.ndarray) -> bytes:
+    """
+    Encode an RGB uint8 image as a png.
+    """
+    height, width, _ = pixels.shape
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    # filter type 0 (none) for every scanline
+    raw[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), PNG_COMPRESSION))
+            + chunk(b"IEND", b""))
+
+
+def draw_chart(lines: List[ChartLine], title: str, ylabel: str, yscale: Optional[str],
+               xticks: List[date]) -> np.ndarray:
+    """
+    Draw a line chart, see plot_lines.
+    :return: HEIGHT x WIDTH RGB canvas, with values within 0..255
+    """
+    canvas = np.full((HEIGHT, WIDTH, 3), 255, dtype=np.float32)
+    log = yscale == "log"
+    day = np.timedelta64(1, "D")
+    epoch = np.datetime64("1970-01-01")
+    xs = [(np.asarray(dates, dtype="datetime64[ns]") - epoch) / day for _, dates, _ in lines]
+    ys = [np.asarray(values, dtype=np.float64) for _, _, values in lines]
+
+    all_x = np.concatenate(xs) if xs else np.array([0.0])
+    all_y = np.concatenate(ys) if ys else np.array([1.0])
+    all_y = all_y[np.isfinite(all_y) & ((all_y > 0) if log else True)]
+    if len(all_y) == 0:
+        all_y = np.array([1.0])
+    x_axis = Axis(all_x.min(), all_x.max(), AXES_LEFT, AXES_RIGHT)
+    y_axis = Axis(all_y.min(), all_y.max(), AXES_BOTTOM, AXES_TOP, log=log)
+
+    # grid and x ticks
+    tick_xs = x_axis((np.array(xticks, dtype="datetime64[D]") - epoch) / day) if xticks else []
+    for tick, x in zip(xticks, tick_xs):
+        x = round(x)
+        if not AXES_LEFT <= x <= AXES_RIGHT:
+            continue
+        fill_rect(canvas, x, AXES_TOP, x + 1, AXES_BOTTOM, GRID_COLOR)
+        fill_rect(canvas, x, AXES_BOTTOM, x + 1, AXES_BOTTOM + TICK_LENGTH, BLACK)
+        draw_text(canvas, tick.strftime("%Y-%m-%d"), x + 1, AXES_BOTTOM + TICK_LENGTH + TICK_PAD, ha="center",
+                  rotated=True)
+    label_width = draw_y_axis(canvas, y_axis)
+
+    points = []
+    entries = []
+    clip = (AXES_LEFT, AXES_TOP, AXES_RIGHT, AXES_BOTTOM)
+    for i, ((label, _, _), x, y) in enumerate(zip(lines, xs, ys)):
+        color = COLORS[i % len(COLORS)]
+        px, py = x_axis(x), y_axis(y)
+        stroke(canvas, px, py, color, LINE_WIDTH, clip)
+        points.append((px, py))
+        entries.append((label, color))
+
+    # axes frame
+    fill_rect(canvas, AXES_LEFT, AXES_TOP, AXES_RIGHT + 1, AXES_TOP + 1, BLACK)
+    fill_rect(canvas, AXES_LEFT, AXES_BOTTOM, AXES_RIGHT + 1, AXES_BOTTOM + 1, BLACK)
+    fill_rect(canvas, AXES_LEFT, AXES_TOP, AXES_LEFT + 1, AXES_BOTTOM + 1, BLACK)
+    fill_rect(canvas, AXES_RIGHT, AXES_TOP, AXES_RIGHT + 1, AXES_BOTTOM + 1, BLACK)
+    if entries:
+        draw_legend(canvas, entries, points)
+
+    draw_text(canvas, title, (AXES_LEFT + AXES_RIGHT) / 2, AXES_TOP - 8, size=TITLE_FONT_SIZE, ha="center",
+              va="bottom")
+    # left of the tick labels, even if that's partly off the canvas: Agg clips the label rather than drawing it
+    # over them
+    draw_text(canvas, ylabel, AXES_LEFT - TICK_LENGTH - TICK_PAD - label_width - 4, (AXES_TOP + AXES_BOTTOM) / 2,
+              ha="right", va="center", rotated=True)
+    # like the Agg chart, the x label only shows if the rotated date labels leave room for it
+    date_label_height = render_text("2020-01-01", FONT_SIZE).shape[1] if xticks else 0
+    xlabel_top = AXES_BOTTOM + TICK_LENGTH + TICK_PAD + date_label_height + 4
+    if xlabel_top + render_text("Date", FONT_SIZE).shape[0] <= HEIGHT:
+        draw_text(canvas, "Date", (AXES_LEFT + AXES_RIGHT) / 2, xlabel_top, ha="center")
+    # blending only ever mixes colors, so the canvas is already within 0..255
+    return canvas
+
+
+def write_png(canvas: np.ndarray, fname: Union[str, BinaryIO]) -> None:
+    canvas += 0.5
+    data = encode_png(canvas.astype(np.uint8))
+    if isinstance(fname, str):
+        with open(fname, "wb") as f:
+            f.write(data)
+    else:
+        fname.write(data)
+
+
+def plot_lines(lines: List[ChartLine], title: str, ylabel: str, yscale: Optional[str], xticks: List[date],
+               fname: Union[str, BinaryIO]) -> None:
+    """
+    Render a line chart to a png.  Same interface as ca_data_parser.plot_lines_agg.
+    :param lines: (label, dates, values) of each series
+    :param title: chart title
+    :param ylabel: y axis label
+    :param yscale: "log" for a logarithmic y axis
+    :param xticks: dates to put x ticks at
+    :param fname: filename or binary file object to write the png to
+    """
+    with metrics.stage("draw"):
+        canvas = draw_chart(lines, title, ylabel, yscale, xticks)
+    with metrics.stage("encode"):
+        write_png(canvas, fname)
+
+
+def plot_charts(charts: List[Tuple[List[ChartLine], str, str, Optional[str]]], xticks: List[date],
+                fname: Union[str, BinaryIO]) -> None:
+    """
+    Render several line charts over the same dates to one png, one above the other.
+    Same interface as ca_data_parser.plot_charts_agg.
+    :param charts: (lines, title, ylabel, yscale) of each chart, as plot_lines takes them
+    :param xticks: dates to put x ticks at
+    :param fname: filename or binary file object to write the png to
+    """
+    with metrics.stage("draw"):
+        canvas = np.concatenate([draw_chart(*chart, xticks) for chart in charts])
+    with metrics.stage("encode"):
+        write_png(canvas, fname)
@@ -0,0 +1,133 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional
+
+from cv19graphs import ca_data_parser, metrics
+
+
+logger = logging.getLogger(__name__)
+# county used to warm up each worker's font cache and renderer
+WARM_UP_FIPS = 6085
+
+
+class RenderQueueFullException(Exception):
+    pass
+
+
+class StaleDataException(Exception):
+    """
+    The worker can't load the data generation a render was asked for, e.g. because the data has been reloaded
+    since the request started.
+    """
+
+
+def init_worker() -> None:
+    if ca_data_parser.dataset is None:
+        ca_data_parser.reload_us_counties()
+
+
+def warm_up() -> None:
+    try:
+        ca_data_parser.render_chart([WARM_UP_FIPS], ca_data_parser.DEFAULT_CHART_TYPE)
+    except ca_data_parser.NoDataAvailableException:
+        pass
+
+
+def render_with_data(fn, generation, *args):
+    """
+    Call fn(*args, data=...) with the worker's dataset, first reloading it if it's older than generation.
+    :param generation: snapshot generation of the data to render, or None for whatever the worker has
+    :raises StaleDataException: if the worker's data isn't generation even after reloading
+    """
+    data = ca_data_parser.dataset
+    if generation is not None and (data.generation is None or data.generation < generation):
+        # the server has reloaded since this worker started; the new snapshot is already there to load
+        data = ca_data_parser.reload_us_counties()
+    if generation is not None and data.generation != generation:
+        raise StaleDataException(f"wanted data generation {generation}, worker has {data.generation}")
+    return fn(*args, data=data)
+
+
+def run_timed(fn, *args):
+    """
+    Run fn, returning the stages it timed along with its result, since the worker's own metrics aren't exposed.
+    """
+    with metrics.collect_stages() as stages:
+        return fn(*args), stages
+
+
+class RenderPool:
+    """
+    Renders charts in a pool of worker processes, each with matplotlib imported and the county data loaded,
+    so rendering is not serialized on the server's GIL.
+    At most max_pending renders may be queued or running at once; further requests fail immediately rather than
+    piling up behind slow renders.
+    """
+
+    def __init__(self, workers: int, max_pending: int, timeout: float):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = self._start_executor()
+
+    def _start_executor(self) -> ProcessPoolExecutor:
+        # spawn rather than fork: the server may have other threads running, and workers load the data themselves
+        executor = ProcessPoolExecutor(max_workers=self.workers,
+                                       mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=init_worker)
+        # workers are started on demand, so submit one warm-up job per worker to start them all now
+        for _ in range(self.workers):
+            executor.submit(warm_up)
+        return executor
+
+    def restart(self) -> None:
+        """
+        Replace the workers with new ones, e.g. so they pick up reloaded data.
+        Renders already running finish on the old workers.
+        """
+        old_executor = self._executor
+        self._executor = self._start_executor()
+        old_executor.shutdown(wait=False)
+        logger.info("Render pool restarted with %d workers", self.workers)
+
+    def render(self, counties: Iterable[int], chart_type: str,
+               backend: str = ca_data_parser.DEFAULT_RENDER_BACKEND, generation: Optional[int] = None) -> bytes:
+        """
+        Render a chart in a worker process.
+        :param generation: snapshot generation of the data to render (see Dataset.generation), or None for the
+                           worker's current data
+        :raises RenderQueueFullException: if max_pending renders are already queued or running
+        :raises concurrent.futures.TimeoutError: if the render did not finish within timeout seconds
+        :raises NoDataAvailableException: if none of the counties are in the data
+        :raises StaleDataException: if the worker can't load generation
+        """
+        return self._run(ca_data_parser.render_chart, generation, list(counties), chart_type, backend)
+
+    def render_charts(self, counties: Iterable[int], chart_types: List[str],
+                      backend: str = ca_data_parser.DEFAULT_RENDER_BACKEND,
+                      generation: Optional[int] = None) -> List[bytes]:
+        """
+        Render a chart of each of chart_types in one go in a worker process, taking up one slot.
+        Raises as render does.
+        """
+        return self._run(ca_data_parser.render_charts, generation, list(counties), list(chart_types), backend)
+
+    def _run(self, fn, generation, *args):
+        if not self._slots.acquire(blocking=False):
+            raise RenderQueueFullException(f"{self.max_pending} renders already pending")
+        try:
+            future = self._executor.submit(run_timed, render_with_data, fn, generation, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # a render that times out keeps its slot until the worker actually finishes it
+        future.add_done_callback(lambda _: self._slots.release())
+        result, stages = future.result(timeout=self.timeout)
+        metrics.record_stages(stages)
+        return result
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
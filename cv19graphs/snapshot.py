@@ -0,0 +1,268 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+# bump whenever the on-disk layout or the derived columns change
+SNAPSHOT_FORMAT = 4
+META_FILENAME = "meta.json"
+LOCK_SUFFIX = ".lock"
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class Snapshot(NamedTuple):
+    # incremented each time a snapshot is saved to the same directory
+    generation: int
+    frame: pd.DataFrame
+    # extra arrays saved along with the frame, memory-mapped like its numeric columns
+    arrays: Dict[str, np.ndarray]
+    # signatures of the sources, as of when the snapshot was saved; see source_signature
+    sources: Dict[str, Dict]
+
+
+@contextmanager
+def locked(dirname: str):
+    """
+    Hold an exclusive lock on the snapshot in dirname, so that of several processes loading the same data,
+    one builds and saves the snapshot while the others wait to load it.
+    Proceeds unlocked if the lock file can't be created.
+    """
+    try:
+        f = open(dirname + LOCK_SUFFIX, "a")
+    except OSError as e:
+        logger.warning("Can't lock snapshot %s: %s", dirname, e)
+        yield
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def file_digest(filename: str, size: Optional[int] = None) -> str:
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        remaining = size if size is not None else float("inf")
+        while remaining > 0:
+            chunk = f.read(int(min(HASH_CHUNK_SIZE, remaining)))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h.hexdigest()
+
+
+def source_signature(filename: str, size: Optional[int] = None) -> Dict:
+    """
+    Describe a source file well enough to tell whether a snapshot built from it is still valid.
+    :param filename: source file the snapshot is derived from
+    :param size: bytes of the file the snapshot was derived from, if not all of it
+    :return: dict with the file's size, mtime and sha1 digest
+    """
+    st = os.stat(filename)
+    return {"size": st.st_size if size is None else size,
+            "mtime_ns": st.st_mtime_ns,
+            "sha1": file_digest(filename, size)}
+
+
+def source_matches(filename: str, signature: Dict) -> bool:
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return False
+    if st.st_size != signature["size"]:
+        return False
+    if st.st_mtime_ns == signature["mtime_ns"]:
+        return True
+    # same size but touched; only a content change invalidates the snapshot
+    return file_digest(filename) == signature["sha1"]
+
+
+def _column_path(dirname: str, name: str, part: str) -> str:
+    return os.path.join(dirname, f"{name}.{part}.npy")
+
+
+def _block_path(dirname: str, dtype: str) -> str:
+    return os.path.join(dirname, f"{dtype}.block.npy")
+
+
+def _block_dtype(column: pd.Series) -> Optional[str]:
+    """
+    :return: the dtype of a plain numeric column, which is stored with the others of its dtype as one 2-D array;
+    None for any other column
+    """
+    dtype = column.dtype
+    if isinstance(dtype, np.dtype) and dtype.kind in "biuf":
+        return dtype.name
+    return None
+
+
+def _save_column(dirname: str, name: str, column: pd.Series) -> Dict:
+    dtype = column.dtype
+    if pd.api.types.is_datetime64_dtype(dtype):
+        np.save(_column_path(dirname, name, "values"), column.to_numpy().view("int64"))
+        return {"name": name, "kind": "datetime"}
+    if isinstance(dtype, pd.CategoricalDtype):
+        np.save(_column_path(dirname, name, "codes"), column.cat.codes.to_numpy())
+        return {"name": name, "kind": "category", "categories": column.cat.categories.tolist()}
+    if isinstance(dtype, pd.StringDtype) or pd.api.types.is_object_dtype(dtype):
+        codes, categories = pd.factorize(column)
+        np.save(_column_path(dirname, name, "codes"), codes.astype("int32"))
+        return {"name": name, "kind": "string", "dtype": dtype.name, "categories": list(categories)}
+    if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        # nullable numeric column: store values and NA mask side by side
+        np.save(_column_path(dirname, name, "values"), column.to_numpy(dtype=dtype.numpy_dtype, na_value=0))
+        np.save(_column_path(dirname, name, "mask"), column.isna().to_numpy())
+        return {"name": name, "kind": "masked", "dtype": dtype.name}
+    np.save(_column_path(dirname, name, "values"), column.to_numpy())
+    return {"name": name, "kind": "numpy"}
+
+
+def _array_path(dirname: str, name: str) -> str:
+    return os.path.join(dirname, f"{name}.array.npy")
+
+
+def read_meta(dirname: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(dirname, META_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _load_frame(dirname: str, specs: List[Dict]) -> pd.DataFrame:
+    # a frame built from separate arrays of one dtype merges them into a new array of its own, which would
+    # leave every process with a private copy; a 2-D array is wrapped as the frame's block as it is
+    blocks: Dict[str, List[str]] = {}
+    for spec in specs:
+        if spec["kind"] == "block":
+            blocks.setdefault(spec["dtype"], []).append(spec["name"])
+    frames = []
+    for spec in specs:
+        if spec["kind"] != "block":
+            frames.append(pd.DataFrame({spec["name"]: _load_column(dirname, spec)}, copy=False))
+        elif spec["name"] == blocks[spec["dtype"]][0]:
+            values = np.load(_block_path(dirname, spec["dtype"]), mmap_mode="r")
+            # one row of values per column
+            frames.append(pd.DataFrame(values.T, columns=blocks[spec["dtype"]], copy=False))
+    return pd.concat(frames, axis=1, copy=False)
+
+
+def _load_column(dirname: str, spec: Dict):
+    name = spec["name"]
+    kind = spec["kind"]
+    if kind == "category":
+        codes = np.load(_column_path(dirname, name, "codes"), mmap_mode="r")
+        return pd.Categorical.from_codes(codes, spec["categories"])
+    if kind == "string":
+        codes = np.load(_column_path(dirname, name, "codes"))
+        return pd.Categorical.from_codes(codes, spec["categories"]).astype(spec["dtype"])
+    values = np.load(_column_path(dirname, name, "values"), mmap_mode="r")
+    if kind == "datetime":
+        return values.view("datetime64[ns]")
+    if kind == "masked":
+        mask = np.load(_column_path(dirname, name, "mask"), mmap_mode="r")
+        array_type = pd.api.types.pandas_dtype(spec["dtype"]).construct_array_type()
+        return array_type(values, mask)
+    return values
+
+
+def save(dirname: str, df: pd.DataFrame, sources: Iterable[str], arrays: Optional[Dict[str, np.ndarray]] = None,
+         sizes: Optional[Dict[str, int]] = None) -> int:
+    """
+    Write df to dirname as one .npy file per column, or per dtype for plain numeric columns, along with the
+    signatures of its sources.
+    The snapshot is written to a temporary directory and then moved into place, as a new generation.
+    Processes that have the previous generation loaded keep their mappings of its files.
+    :param dirname: snapshot directory
+    :param df: derived dataset to store
+    :param sources: files df was derived from
+    :param arrays: name -> array of other data derived from sources
+    :param sizes: source -> bytes of it the data was derived from, for sources only partially read
+    :return: generation number of the new snapshot
+    """
+    arrays = arrays or {}
+    sizes = sizes or {}
+    old_meta = read_meta(dirname)
+    generation = old_meta.get("generation", 0) + 1 if old_meta else 1
+    tmp_dirname = f"{dirname}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dirname, ignore_errors=True)
+    os.makedirs(tmp_dirname)
+    try:
+        columns = []
+        blocks: Dict[str, List[str]] = {}
+        for name in df.columns:
+            dtype = _block_dtype(df[name])
+            if dtype is None:
+                columns.append(_save_column(tmp_dirname, name, df[name]))
+            else:
+                columns.append({"name": name, "kind": "block", "dtype": dtype})
+                blocks.setdefault(dtype, []).append(name)
+        for dtype, names in blocks.items():
+            np.save(_block_path(tmp_dirname, dtype), np.stack([df[name].to_numpy() for name in names]))
+        for name, array in arrays.items():
+            np.save(_array_path(tmp_dirname, name), array)
+        meta = {"format": SNAPSHOT_FORMAT,
+                "generation": generation,
+                "rows": len(df),
+                "columns": columns,
+                "arrays": list(arrays),
+                "sources": {src: source_signature(src, sizes.get(src)) for src in sources}}
+        with open(os.path.join(tmp_dirname, META_FILENAME), "w") as f:
+            json.dump(meta, f)
+        old_dirname = f"{dirname}.old-{os.getpid()}"
+        if os.path.exists(dirname):
+            os.rename(dirname, old_dirname)
+        os.rename(tmp_dirname, dirname)
+        shutil.rmtree(old_dirname, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+        raise
+    return generation
+
+
+def load(dirname: str, sources: Iterable[str]) -> Optional[Snapshot]:
+    """
+    Load the snapshot in dirname if it was built from the current contents of sources.
+    Numeric and datetime columns, categorical codes and arrays are memory-mapped rather than read into memory,
+    so processes loading the same snapshot share one copy of them.  Numeric columns of one dtype are kept
+    together, where the first of them was.
+    :param dirname: snapshot directory
+    :param sources: files the snapshot must have been derived from
+    :return: the stored data, or None if there is no valid snapshot
+    """
+    meta = read_meta(dirname)
+    if meta is None:
+        return None
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        logger.info("Snapshot %s has format %s, wanted %d", dirname, meta.get("format"), SNAPSHOT_FORMAT)
+        return None
+    signatures = meta["sources"]
+    sources = list(sources)
+    if set(signatures) != set(sources):
+        return None
+    for src in sources:
+        if not source_matches(src, signatures[src]):
+            logger.info("Snapshot %s is stale: %s changed", dirname, src)
+            return None
+    try:
+        frame = _load_frame(dirname, meta["columns"])
+        arrays = {name: np.load(_array_path(dirname, name), mmap_mode="r") for name in meta["arrays"]}
+    except (OSError, ValueError) as e:
+        logger.warning("Failed to load snapshot %s: %s", dirname, e)
+        return None
+    return Snapshot(generation=meta["generation"],
+                    frame=frame,
+                    arrays=arrays,
+                    sources=signatures)
@@ -1,14 +1,361 @@
+import gzip
+import io
+import json
+import os
+import resource
+import signal
+import struct
+import subprocess
+import sys
+import time
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
+from urllib.error import HTTPError
+from urllib.request import urlopen
 
 import numpy
 import pandas as pd
+import pytest
 
+from cv19graphs import benchmarks, ca_data_parser, flaskgzip, loadtest, metrics, raster, snapshot, \
+    update_csv_and_mappings
 from cv19graphs.ca_data_parser import decimate_ticks, combine_date_ranges, get_county_data
+from cv19graphs.chart_cache import ChartCache, ChartPopularity
+from cv19graphs.county_search import CountySearch
+from cv19graphs.graph_jobs import JobQueue, SingleFlight
+from cv19graphs.render_pool import RenderPool, RenderQueueFullException, StaleDataException
+from covid19scc import backfill
+
+# renders in the leak regression test; each one takes ~0.1s, so set e.g. LEAK_TEST_RENDERS=2000 for a longer run
+LEAK_TEST_RENDERS = int(os.environ.get("LEAK_TEST_RENDERS", 100))
+# seconds importing the server module may take; it must not load data or matplotlib
+IMPORT_TIME_BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", 1.0))
 
 
 def setup_module(_):
     pd.set_option('display.max_rows', 500)
+    if ca_data_parser.dataset is None:
+        ca_data_parser.reload_us_counties()
+
+
+def get_server():
+    from cv19graphs import data_parser_server as server
+    if server.site_data is None:
+        server.reload_site_data()
+    return server
+
+
+def test_import_time():
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "from cv19graphs import ca_data_parser, data_parser_server\n"
+            "print(time.perf_counter() - start)\n"
+            "assert ca_data_parser.dataset is None and data_parser_server.site_data is None\n"
+            "assert 'matplotlib' not in sys.modules\n")
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=package_dir)
+    # best of a few runs, to not fail on a cold disk cache
+    times = [float(subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                                  capture_output=True, text=True).stdout)
+             for _ in range(3)]
+    assert min(times) < IMPORT_TIME_BUDGET
+
+
+def test_readiness():
+    server = get_server()
+    client = server.app.test_client()
+    assert client.get("/healthz").status_code == 200
+    assert client.get("/readyz").json["status"] == "ready"
+    # as if the first load hadn't finished yet
+    with patch.object(server, "site_data", None):
+        assert client.get("/healthz").status_code == 200
+        response = client.get("/readyz")
+        assert response.status_code == 503 and response.json["status"] == "loading"
+        response = client.post("/graph", json={"counties": [6085]})
+        assert response.status_code == 503 and "Retry-After" in response.headers
+        assert client.get("/").status_code == 503
+    assert client.post("/graph", json={"counties": [6085]}).status_code == 200
+
+    # a first load that fails is retried until it succeeds, rather than leaving the server unready for good
+    attempts = []
+
+    class Loaded(BaseException):
+        pass
+
+    def flaky_reload():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise FileNotFoundError("us-counties.csv")
+        # loaded: stop this test's reloader
+        raise Loaded
+
+    def run_reloader():
+        with pytest.raises(Loaded):
+            server.run_reloader()
+
+    with patch.object(server, "site_data", None), patch.object(server, "reload_site_data", flaky_reload), \
+            patch.object(server, "reload_requested", threading.Event()), \
+            patch.object(server, "LOAD_RETRY_MIN_SECONDS", 0.05):
+        reloader = threading.Thread(target=run_reloader, daemon=True)
+        reloader.start()
+        server.reload_requested.set()
+        reloader.join(10)
+    assert len(attempts) == 3 and attempts[1] - attempts[0] >= 0.05 and attempts[2] - attempts[1] >= 0.1
+
+
+def test_index_page():
+    server = get_server()
+    client = server.app.test_client()
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200 and response.headers["Content-Encoding"] == "gzip"
+    html = gzip.decompress(response.data)
+    # counties are searched for through /counties rather than all embedded in the page
+    assert b"Santa Clara" not in html and server.site_data.dataset.latest_date.encode() in html
+    etag = response.headers["ETag"]
+
+    plain = client.get("/")
+    assert "Content-Encoding" not in plain.headers and plain.data == html
+    assert plain.headers["ETag"] != etag
+
+    response = client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304 and response.data == b""
+    # the page is rebuilt on reload, and is the same page if the data is the same
+    page = server.site_data.index_page
+    server.reload_site_data()
+    assert server.site_data.index_page is not page and server.site_data.index_page.etag == page.etag
+    assert client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}).status_code == 304
+
+
+def test_county_search():
+    search = CountySearch({"California - Santa Clara": 6085, "California - San Mateo": 6081,
+                           "New York - New York City": 36061, "Texas - Clay": 48077, "Kansas - Clark": 20025})
+    # county name matches first, then state, then later words
+    assert search.search("cla", 10) == [("Kansas - Clark", 20025), ("Texas - Clay", 48077),
+                                        ("California - Santa Clara", 6085)]
+    assert search.search("CALIFORNIA - SANTA", 10) == [("California - Santa Clara", 6085)]
+    assert search.search("york ci", 10) == [("New York - New York City", 36061)]
+    assert search.search("cla", 2) == [("Kansas - Clark", 20025), ("Texas - Clay", 48077)]
+    assert search.search("", 10) == [] and search.search("zz", 10) == []
+    assert search.lookup([6081, 1]) == [("California - San Mateo", 6081)]
+
+    server = get_server()
+    client = server.app.test_client()
+    response = client.get("/counties?q=santa%20c")
+    assert {"place": "California - Santa Clara", "fips": 6085} in response.json["counties"]
+    assert len(client.get("/counties?q=s&limit=1").json["counties"]) == 1
+    assert client.get("/counties?fips=6085,6081").json["counties"] == [
+        {"place": "California - Santa Clara", "fips": 6085}, {"place": "California - San Mateo", "fips": 6081}]
+    assert client.get("/counties?fips=x").status_code == 400
+
+
+def test_metrics():
+    server = get_server()
+    client = server.app.test_client()
+    renders = server.RENDERS.get(backend=server.RENDER_BACKEND)
+    # a chart no other test renders, so it isn't cached
+    response = client.post("/graph", json={"counties": [6085, 17031, 36061], "chart": "cases_log"})
+    timing = dict(entry.split(";dur=") for entry in response.headers["Server-Timing"].split(", "))
+    assert {"parse", "cache", "render", "block", "dates", "lines", "total"} <= set(timing)
+    assert float(timing["total"]) >= float(timing["render"]) > 0
+    assert server.RENDERS.get(backend=server.RENDER_BACKEND) > renders
+    client.post("/graph", json={"counties": [6085, 17031, 36061], "chart": "cases_log"})
+    assert "render" not in client.post("/graph", json={"counties": [6085, 17031, 36061], "chart": "cases_log"}
+                                       ).headers["Server-Timing"]
+
+    response = client.get("/metrics")
+    assert response.status_code == 200 and response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    for sample in ('cv19_stage_seconds_bucket{stage="block",le="+Inf"}', 'cv19_renders_total{backend=',
+                   'cv19_chart_cache_lookups_total{result="hit"}', 'cv19_request_seconds_count{endpoint="handle_graph"}',
+                   "cv19_reload_seconds_count", "cv19_dataset_rows", "cv19_chart_cache_bytes"):
+        assert sample in text
+    rows = [line for line in text.splitlines() if line.startswith("cv19_dataset_rows ")]
+    assert rows == [f"cv19_dataset_rows {len(server.site_data.dataset.counties)}"]
+    with patch.object(server, "site_data", None):
+        assert client.get("/metrics").status_code == 200
+
+
+def test_compression():
+    server = get_server()
+    client = server.app.test_client()
+    gzip_headers = {"Accept-Encoding": "gzip"}
+    with open(os.path.join("static", "error.svg"), "rb") as f:
+        svg = f.read()
+    response = client.get("/static/error.svg", headers=gzip_headers)
+    assert response.headers["Content-Encoding"] == "gzip" and gzip.decompress(response.data) == svg
+    etag = response.headers["ETag"]
+    assert etag.startswith("W/")
+    assert client.get("/static/error.svg", headers={**gzip_headers, "If-None-Match": etag}).status_code == 304
+
+    series = client.post("/series", json={"counties": [6085, 6081]}, headers=gzip_headers)
+    assert series.headers["Content-Encoding"] == "gzip" and "Accept-Encoding" in series.headers["Vary"]
+    plain = client.post("/series", json={"counties": [6085, 6081]})
+    assert "Content-Encoding" not in plain.headers and gzip.decompress(series.data) == plain.data
+
+    url = client.post("/graph", json={"counties": [6085]}).json["covid_graph"]
+    assert "Content-Encoding" not in client.get(url, headers=gzip_headers).headers
+
+    # streamed responses are compressed as they're sent
+    chunks = [b"%d," % i * 100 for i in range(100)]
+    with server.app.test_request_context(headers=gzip_headers):
+        response = flaskgzip.compress_response(server.Response(iter(chunks), mimetype="text/csv"))
+        assert "Content-Length" not in response.headers
+        assert gzip.decompress(b"".join(response.response)) == b"".join(chunks)
+        small = flaskgzip.compress_response(server.Response(b"[]", mimetype="application/json"))
+        assert "Content-Encoding" not in small.headers
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        started.set()
+        release.wait(10)
+        return x * 2
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        leader = executor.submit(flights.do, "a", slow, 1)
+        started.wait(10)
+        followers = [executor.submit(flights.do, "a", slow, 1) for _ in range(3)]
+        # time for the followers to find the call in flight
+        time.sleep(0.2)
+        release.set()
+        assert leader.result() == (2, False) and [f.result() for f in followers] == [(2, True)] * 3
+    assert calls == [1] and len(flights) == 0
+    with pytest.raises(ZeroDivisionError):
+        flights.do("b", lambda: 1 / 0)
+
+    jobs = JobQueue(workers=1, max_pending=1, keep_seconds=60)
+    release.clear()
+    job, coalesced = jobs.submit("a", slow, 2)
+    assert not coalesced and jobs.submit("a", slow, 2) == (job, True)
+    with pytest.raises(RenderQueueFullException):
+        jobs.submit("b", slow, 3)
+    assert job.status == "pending" and not job.wait(0.01)
+    release.set()
+    assert job.wait(10) and job.status == "done" and job.future.result() == 4
+    assert jobs.get(job.id) is job and jobs.pending == 0
+    assert jobs.submit("a", lambda: 1 / 0)[0].wait(10) and jobs.get(job.id).status == "done"
+    jobs.shutdown()
+
+
+def test_graph_jobs():
+    server = get_server()
+    client = server.app.test_client()
+    release = threading.Event()
+    render_missing = server.render_missing
+    rendered = []
+
+    def blocked_render_missing(dataset, cache_keys):
+        release.wait(10)
+        rendered.extend(cache_keys)
+        return render_missing(dataset, cache_keys)
+
+    with patch.object(server, "chart_cache", ChartCache(1 << 24, 16)), \
+            patch.object(server, "render_missing", blocked_render_missing):
+        coalesced = server.RENDERS_COALESCED.get()
+        # a link going round: the same chart requested many times at once is rendered once
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(server.render_graph, server.site_data.dataset, [6085, 6081], "deaths")
+                       for _ in range(4)]
+            time.sleep(0.2)
+            release.set()
+            pngs = {f.result()[1] for f in futures}
+        assert len(pngs) == 1 and len(rendered) == 1
+        assert server.RENDERS_COALESCED.get() == coalesced + 3
+
+        release.clear()
+        response = client.post("/graph", json={"counties": [6085], "chart": "new_deaths", "async": True})
+        assert response.status_code == 202 and response.json["status"] == "pending"
+        job_url = response.headers["Location"]
+        assert response.json["job_url"] == job_url
+        again = client.post("/graph", json={"counties": ["6085"], "chart": "new_deaths", "async": True})
+        assert again.json["job"] == response.json["job"]
+        assert client.get(job_url).json["status"] == "pending"
+        release.set()
+        status = client.get(job_url + "?wait=10").json
+        assert status["status"] == "done" and [chart for _, chart, _ in rendered] == ["deaths", "new_deaths"]
+        assert client.get(status["covid_graph"]).data.startswith(b"\x89PNG")
+
+    events = client.get(job_url + "/events", headers={"Accept-Encoding": "gzip"})
+    assert events.mimetype == "text/event-stream" and "Content-Encoding" not in events.headers
+    assert [json.loads(line[len("data: "):]) for line in events.get_data(as_text=True).split("\n\n") if line] \
+        == [status]
+    failed = client.post("/graph", json={"counties": [1], "async": True}).json
+    failed = client.get(failed["job_url"] + "?wait=10").json
+    assert failed["status"] == "failed" and failed["error"].startswith("No data")
+    assert client.get("/jobs/bogus").status_code == 404
+    # invalid charts are turned away before they take up a place in the queue
+    jobs = len(server.graph_jobs)
+    for chart in ("bogus", "+".join(["cases"] * (server.MAX_BATCH_CHARTS + 1))):
+        assert client.post("/graph", json={"counties": [6085], "chart": chart, "async": True}).status_code == 400
+    assert len(server.graph_jobs) == jobs
+
+
+def test_chart_cache_eviction():
+    cache = ChartCache(max_bytes=10, max_entries=3)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"
+    # over max_bytes: evicts the least recently used entry
+    cache.put("c", b"1234")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    cache.put("d", b"1")
+    cache.put("e", b"1")
+    assert len(cache) == 3 and cache.get("a") is None
+    cache.put("big", b"x" * 11)
+    assert cache.get("big") is None
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_prerender_popular():
+    server = get_server()
+    popularity = ChartPopularity(max_tracked=4)
+    for key, count in ((("cases", (6085,)), 3), (("deaths", (6081, 6085)), 2), (("cases", (6001,)), 1)):
+        for _ in range(count):
+            popularity.record(key)
+    assert popularity.most_common(2) == [("cases", (6085,)), ("deaths", (6081, 6085))]
+    popularity.record(("cases", (1,)))
+    popularity.record(("cases", (2,)))
+    # over max_tracked: only the more popular half is kept
+    assert popularity.most_common(5) == [("cases", (6085,)), ("deaths", (6081, 6085))]
+
+    with patch.object(server, "chart_popularity", popularity), \
+            patch.object(server, "chart_cache", ChartCache(1 << 24, 16)), \
+            patch.object(server, "RENDER_WORKERS", 0):
+        assert server.prerender_popular(1) == 1
+        version = server.site_data.dataset.version
+        assert server.chart_cache.get((version, "cases", (6085,))) is not None
+        assert server.chart_cache.get((version, "deaths", (6081, 6085))) is None
+
+
+def test_background_reload():
+    server = get_server()
+    server.start_reloader()
+    old = server.site_data
+    with patch.object(server, "PRERENDER_COUNT", 0):
+        # the handler runs on this thread, which may be holding the lock start_loading takes
+        with server.reloader_lock:
+            os.kill(os.getpid(), signal.SIGHUP)
+        for _ in range(300):
+            if server.site_data is not old:
+                break
+            time.sleep(0.1)
+    new = server.site_data
+    assert new.dataset.version == old.dataset.version + 1
+    assert new.county_search.fips_county_mapping == old.county_search.fips_county_mapping
+    assert new.county_search is not old.county_search
+    # requests that started on the old data can still finish with it
+    assert ca_data_parser.render_chart([6085], "cases", data=old.dataset).startswith(b"\x89PNG")
 
 
 def test_combine_date_ranges():
@@ -18,6 +365,12 @@ def test_combine_date_ranges():
     for dr in drs:
         for date in dr.array.date:
             assert date in combined.array.date
+    assert combined.is_monotonic_increasing and combined.is_unique
+    # needs nothing but the frames, not the loaded data
+    with patch.object(ca_data_parser, "dataset", None):
+        early = make_county_df(6085, "Santa Clara", "California", days=10)
+        late = early.assign(date=early.date + timedelta(days=5))
+        assert list(combine_date_ranges([late, early])) == list(pd.date_range("2020-03-01", periods=15))
 
 
 def test_decimate_ticks_current():
@@ -38,3 +391,505 @@ def test_decimate_ticks_current():
     assert ticks[-1] == last_day.date()
     second_to_last = ticks[-2]
     assert last_day.date() - second_to_last >= timedelta(days=7)
+
+
+def test_per_capita_columns():
+    df = get_county_data([6085])[0]
+    population = ca_data_parser.dataset.populations[("California", "Santa Clara")]
+    block = ca_data_parser.get_county_block([6085])
+    numpy.testing.assert_allclose(block.values["cases_pc"][:, 0], df.cases / population)
+    counties = ca_data_parser.dataset.counties
+    assert counties.fips.dtype == "int32"
+    # served from the snapshot, rather than each process holding its own copy
+    for column in ("fips", "cases", "deaths", "new_cases", "new_deaths"):
+        assert is_mapped(counties[column].to_numpy())
+
+
+def test_county_block():
+    dfs = get_county_data([6073, 1, 17031])
+    block = ca_data_parser.get_county_block([6073, 1, 17031])
+    assert list(block.fips) == [6073, 17031]
+    assert block.labels == ["San Diego,California", "Cook,Illinois"]
+    assert block.present.sum() == sum(len(df) for df in dfs)
+    for i, df in enumerate(dfs):
+        rows = numpy.searchsorted(block.dates, df.date.to_numpy())
+        assert block.present[rows, i].all()
+        assert list(block.values["new_cases"][rows, i]) == list(df.new_cases)
+    assert numpy.isnan(block.values["cases"][~block.present]).all()
+    # the start is the first date any county had more than 5 cases
+    start = ca_data_parser.find_chart_start(block)
+    first = min(df.date[df.cases > 5].iloc[0] for df in dfs)
+    assert block.dates[start] == first
+    assert ca_data_parser.get_county_block([1]) is None
+
+
+def is_mapped(values):
+    while not isinstance(values, numpy.memmap):
+        if not isinstance(values.base, numpy.ndarray):
+            return False
+        values = values.base
+    return True
+
+
+def test_snapshot_roundtrip(tmp_path):
+    source = tmp_path / "source.csv"
+    source.write_text("a,b\n1,2\n")
+    df = pd.DataFrame({"state": ["California", "Illinois", None],
+                       "county": pd.Categorical(["Santa Clara", "Cook", "Santa Clara"]),
+                       "date": pd.to_datetime(["2020-03-01", "2020-03-02", "2020-03-03"]),
+                       "cases": pd.array([1, None, 3], dtype="Int32"),
+                       "cases_pc": [0.5, 0.25, 0.125],
+                       "fips": numpy.array([6085, 17031, 6085], dtype="int32"),
+                       "deaths": numpy.array([0, 1, 2], dtype="int32")})
+    snapshot_dir = str(tmp_path / "snapshot")
+    arrays = {"present": numpy.eye(3, dtype=bool), "labels": numpy.array(["a", "bc"])}
+    assert snapshot.save(snapshot_dir, df, [str(source)], arrays) == 1
+    loaded = snapshot.load(snapshot_dir, [str(source)])
+    pd.testing.assert_frame_equal(loaded.frame, df)
+    assert loaded.generation == 1 and loaded.sources[str(source)]["size"] == source.stat().st_size
+    for name, array in arrays.items():
+        numpy.testing.assert_array_equal(loaded.arrays[name], array)
+    assert isinstance(loaded.arrays["present"], numpy.memmap)
+    # the frame's columns are views of the mapped files too, even once pandas has consolidated its columns of
+    # one dtype (as taking several of them at once does)
+    loaded.frame[["fips", "deaths"]]
+    for column in ("date", "cases_pc", "fips", "deaths"):
+        assert is_mapped(loaded.frame[column].to_numpy())
+    assert is_mapped(loaded.frame.county.cat.codes.to_numpy())
+    assert snapshot.save(snapshot_dir, df, [str(source)]) == 2
+
+    source.write_text("a,b\n1,2\n3,4\n")
+    assert snapshot.load(snapshot_dir, [str(source)]) is None
+
+
+def test_appended_rows_continue_deltas():
+    lines = ["date,county,state,fips,cases,deaths",
+             "2020-03-01,Santa Clara,California,6085,1,0",
+             "2020-03-01,San Mateo,California,6081,2,0",
+             "2020-03-02,Santa Clara,California,6085,4,1",
+             "2020-03-02,San Mateo,California,6081,2,0",
+             "2020-03-03,Santa Clara,California,6085,9,1",
+             "2020-03-03,San Mateo,California,6081,7,2"]
+    full = ca_data_parser.add_derived_columns(
+        ca_data_parser.read_counties_csv(io.StringIO("\n".join(lines))))
+
+    head = ca_data_parser.add_derived_columns(
+        ca_data_parser.read_counties_csv(io.StringIO("\n".join(lines[:3]))))
+    tail = ca_data_parser.add_derived_columns(
+        ca_data_parser.read_counties_csv(io.StringIO("\n".join(lines[3:])), names=lines[0].split(",")),
+        ca_data_parser.get_last_cumulative(head))
+    columns = ["date", "fips", "cases", "new_cases", "new_deaths"]
+    expected = full.loc[full.date > "2020-03-01", columns].sort_values(["fips", "date"], ignore_index=True)
+    pd.testing.assert_frame_equal(tail[columns].sort_values(["fips", "date"], ignore_index=True), expected)
+    assert list(expected.new_cases) == [0, 5, 3, 5]
+
+    combined = ca_data_parser.concat_counties([head, tail])
+    assert combined.state.dtype == "category" and list(combined.county.cat.categories) == ["San Mateo", "Santa Clara"]
+
+
+def test_read_appended_rows(tmp_path):
+    filename = str(tmp_path / "us-counties.csv")
+    rows = ["date,county,state,fips,cases,deaths\n", "2020-03-01,Santa Clara,California,6085,1234,0\n"]
+    rows += ["2020-03-02,San Mateo,California,6081,%d,0\n" % i for i in range(200)]
+    with open(filename, "w") as f:
+        f.writelines(rows)
+    state = ca_data_parser.read_source_state(filename, os.path.getsize(filename))
+    appended = "2020-03-03,Santa Clara,California,6085,1300,1\n"
+    with open(filename, "a") as f:
+        f.write(appended)
+    new_rows, offset = ca_data_parser.read_appended_rows(state)
+    assert list(new_rows.cases) == [1300] and offset == os.path.getsize(filename)
+
+    # history revised in place, further back than the rows just before the new ones
+    with open(filename, "w") as f:
+        f.writelines([rows[0], rows[1].replace("1234", "1243")] + rows[2:] + [appended])
+    assert ca_data_parser.read_appended_rows(state) is None
+
+
+def make_county_df(fips, county, state, days=30):
+    cases = numpy.arange(days) * fips % 97 + numpy.arange(days) * 10
+    return pd.DataFrame({"date": pd.date_range("2020-03-01", periods=days),
+                         "county": county,
+                         "state": state,
+                         "fips": fips,
+                         "cases": cases,
+                         "deaths": cases // 50,
+                         "new_cases": numpy.r_[0, numpy.diff(cases)],
+                         "new_deaths": numpy.r_[0, numpy.diff(cases // 50)]})
+
+
+def render_png(dfs, chart_type):
+    return render_png_backend(dfs, chart_type, "agg")
+
+
+def render_png_backend(dfs, chart_type, backend):
+    buf = io.BytesIO()
+    ca_data_parser.plot_counties(ca_data_parser.make_county_block(dfs), chart_type, buf, backend)
+    return buf.getvalue()
+
+
+def test_plot_counties_threads():
+    charts = [([make_county_df(6085, "Santa Clara", "California")], "cases"),
+              ([make_county_df(6081, "San Mateo", "California")], "new_cases"),
+              ([make_county_df(6085, "Santa Clara", "California"),
+                make_county_df(17031, "Cook", "Illinois")], "cases_log")]
+    expected = [render_png(dfs, chart_type) for dfs, chart_type in charts]
+    with ThreadPoolExecutor(max_workers=len(charts)) as executor:
+        for _ in range(4):
+            futures = [executor.submit(render_png, dfs, chart_type) for dfs, chart_type in charts]
+            assert [f.result() for f in futures] == expected
+
+
+def test_plot_counties_memory_flat():
+    dfs = [make_county_df(6085, "Santa Clara", "California", days=10)]
+    for _ in range(50):
+        render_png(dfs, "cases")
+    # ru_maxrss is in KiB on linux, bytes on macos
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for _ in range(LEAK_TEST_RENDERS):
+        render_png(dfs, "cases")
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    scale = 1 if sys.platform == "darwin" else 1024
+    assert rss_growth * scale < 16 * 1024 * 1024
+
+
+def test_render_pool():
+    pool = RenderPool(workers=1, max_pending=2, timeout=60)
+    try:
+        assert pool.render([6085], "cases").startswith(b"\x89PNG")
+        with pytest.raises(ca_data_parser.NoDataAvailableException):
+            pool.render([1], "cases")
+        # stages timed in the worker count towards the request that asked for the render
+        with metrics.collect_stages() as stages:
+            pool.render([6085], "deaths")
+        assert {"block", "dates", "lines", "figure", "savefig"} <= {name for name, _ in stages}
+        assert pool.render_charts([6085], ["cases", "deaths"]) == [ca_data_parser.render_chart([6085], "cases"),
+                                                                  ca_data_parser.render_chart([6085], "deaths")]
+
+        # workers render the data generation they're asked for, or refuse
+        generation = ca_data_parser.dataset.generation
+        assert generation is not None
+        assert pool.render([6085], "cases", generation=generation).startswith(b"\x89PNG")
+        for other in (generation - 1, generation + 1):
+            with pytest.raises(StaleDataException):
+                pool.render([6085], "cases", generation=other)
+        # and then the server renders it itself, from the data the request started with
+        server = get_server()
+        dataset = server.site_data.dataset._replace(generation=generation + 1)
+        with patch.object(server, "render_pool", pool), patch.object(server, "chart_cache", ChartCache(1 << 24, 16)):
+            _, data = server.render_graph(dataset, [6085], "new_cases")
+        assert data == ca_data_parser.render_chart([6085], "new_cases", server.RENDER_BACKEND, dataset)
+    finally:
+        pool.shutdown()
+
+
+def test_render_charts():
+    for backend in ca_data_parser.RENDER_BACKENDS:
+        charts = ["cases", "new_cases_7d", "deaths+cases_log"]
+        pngs = ca_data_parser.render_charts([6085, 6081], charts, backend)
+        assert pngs[:2] == [ca_data_parser.render_chart([6085, 6081], chart, backend) for chart in charts[:2]]
+        single_height = struct.unpack(">I", pngs[0][20:24])[0]
+        assert struct.unpack(">II", pngs[2][16:24]) == (struct.unpack(">I", pngs[0][16:20])[0], 2 * single_height)
+        assert pngs[2] == ca_data_parser.render_chart([6085, 6081], "deaths+cases_log", backend)
+    with pytest.raises(ValueError):
+        ca_data_parser.render_charts([6085], ["cases+bogus"])
+
+    server = get_server()
+    client = server.app.test_client()
+    response = client.post("/graphs", json={"counties": [6085], "charts": ["cases", "deaths"]})
+    urls = response.json["covid_graphs"]
+    assert list(urls) == ["cases", "deaths"] and "/deaths/" in urls["deaths"]
+    assert client.get(urls["deaths"]).data == ca_data_parser.render_chart([6085], "deaths", server.RENDER_BACKEND)
+    response = client.post("/graphs", json={"counties": [6085], "charts": ["cases", "deaths"], "combined": True})
+    combined = client.get(response.json["covid_graphs"]["cases+deaths"])
+    assert combined.status_code == 200 and combined.mimetype == "image/png"
+    for charts in ([], ["bogus"], "cases", ["cases"] * (server.MAX_BATCH_CHARTS + 1)):
+        assert client.post("/graphs", json={"counties": [6085], "charts": charts}).status_code == 400
+    # combined charts from /graph are held to the same limit, rather than rendered and then 404ing
+    too_many = "+".join(["cases"] * (server.MAX_BATCH_CHARTS + 1))
+    for chart in (too_many, "bogus", "cases+bogus"):
+        assert client.post("/graph", json={"counties": [6085], "chart": chart}).status_code == 400
+        assert client.post("/series", json={"counties": [6085], "chart": chart}).status_code == 400
+    url = client.post("/graph", json={"counties": [6085], "chart": "cases+deaths"}).json["covid_graph"]
+    assert client.get(url).status_code == 200
+
+
+def test_rolling_metrics():
+    df = make_county_df(6085, "Santa Clara", "California", days=30)
+    # cases double every 7 days from 100
+    df["cases"] = (100 * 2 ** (numpy.arange(30) / 7)).round().astype(int)
+    df["new_cases"] = numpy.r_[0, numpy.diff(df.cases)]
+    population = ca_data_parser.dataset.populations[("California", "Santa Clara")]
+    block = ca_data_parser.make_county_block([df])
+    values = block.values
+    assert numpy.isnan(values["new_cases_7d"][:6, 0]).all()
+    numpy.testing.assert_allclose(values["new_cases_7d"][6:, 0], df.new_cases.rolling(7).mean()[6:])
+    numpy.testing.assert_allclose(values["incidence_7d"][6:, 0],
+                                  df.new_cases.rolling(7).sum()[6:] / population * 100000)
+    numpy.testing.assert_allclose(values["doubling_time"][7:, 0], 7, rtol=0.01)
+    # weekly new cases double too, once the first week (with no new cases on day 0) is out of the window
+    numpy.testing.assert_allclose(values["growth_wow"][14:, 0], 100, atol=2)
+
+    # the load-time matrices agree with building a block from the rows
+    counties = [6085, 17031]
+    gathered = ca_data_parser.get_county_block(counties)
+    built = ca_data_parser.make_county_block(get_county_data(counties))
+    for column, matrix in built.values.items():
+        numpy.testing.assert_allclose(gathered.values[column], matrix, rtol=1e-6)
+
+
+def test_get_chart_series():
+    early = make_county_df(6085, "Santa Clara", "California", days=10)
+    late = make_county_df(6081, "San Mateo", "California", days=10)
+    late["date"] += pd.Timedelta(days=5)
+    block = ca_data_parser.make_county_block([early, late])
+    series = ca_data_parser.get_chart_series(block, "cases")
+    start = pd.Timestamp(block.dates[ca_data_parser.find_chart_start(block)])
+    assert series["base_date"] == start.strftime("%Y-%m-%d")
+    assert series["ticks"][0] == 0
+    santa_clara, san_mateo = series["series"]
+    assert santa_clara["label"] == "Santa Clara,California"
+    truncated = early.loc[early.date >= start]
+    assert santa_clara["offsets"] == list(range(len(truncated)))
+    assert santa_clara["values"] == list(truncated.cases)
+    assert san_mateo["offsets"][0] == (late.date.iloc[0] - start).days
+
+
+def test_raster_backend():
+    dfs = [make_county_df(6085, "Santa Clara", "California"), make_county_df(17031, "Cook", "Illinois")]
+    for chart_type in ("cases", "cases_log"):
+        png = render_png_backend(dfs, chart_type, "raster")
+        assert png[:8] == b"\x89PNG\r\n\x1a\n"
+        width, height = struct.unpack(">II", png[16:24])
+        assert (width, height) == (raster.WIDTH, raster.HEIGHT)
+        idat_length = struct.unpack(">I", png[33:37])[0]
+        pixels = numpy.frombuffer(zlib.decompress(png[41:41 + idat_length]), dtype=numpy.uint8)
+        rows = pixels.reshape(height, width * 3 + 1)[:, 1:].reshape(height, width, 3)
+        for color in raster.COLORS[:len(dfs)]:
+            assert (rows == color).all(axis=2).any()
+
+    # wide tick labels push the y label left, off the edge if need be, rather than under it
+    lines = [(label, df.date.to_numpy(), df.cases.to_numpy() / 3e6) for label, df in zip(["a", "b"], dfs)]
+    plain = raster.draw_chart(lines, "", "", None, [])
+    labeled = raster.draw_chart(lines, "", "Cases p/c", None, [])
+    label_columns = numpy.flatnonzero((plain != labeled).any(axis=(0, 2)))
+    tick_label_columns = numpy.flatnonzero((plain[:, :raster.AXES_LEFT - raster.TICK_LENGTH] < 255).any(axis=(0, 2)))
+    assert len(label_columns) and label_columns.max() < tick_label_columns.min()
+
+
+def test_nice_ticks():
+    assert list(raster.nice_ticks(0, 30000)) == [0, 5000, 10000, 15000, 20000, 25000, 30000]
+    assert list(raster.format_ticks(numpy.array([0, 0.5, 1.0]))[0]) == ["0.0", "0.5", "1.0"]
+    assert raster.format_ticks(numpy.array([0, 1e6, 2e6]))[1] == 6
+
+
+def test_synthetic_counties(tmp_path):
+    filenames = [str(tmp_path / name) for name in ("a.csv", "a-pops.csv", "b.csv", "b-pops.csv")]
+    rows = benchmarks.write_counties_csv(filenames[0], filenames[1], counties=120, days=40, seed=3)
+    assert benchmarks.write_counties_csv(filenames[2], filenames[3], counties=120, days=40, seed=3) == rows
+    with open(filenames[0], "rb") as a, open(filenames[2], "rb") as b:
+        assert a.read() == b.read()
+
+    data = ca_data_parser.load_dataset(filenames[0], filenames[1])
+    assert len(data.counties) == rows and data.latest_date == "2020-02-29"
+    unknowns = data.counties[data.counties.county == "Unknown"]
+    assert len(unknowns) and (unknowns.fips == ca_data_parser.NO_FIPS).all()
+    assert (data.counties.groupby("fips").date.is_monotonic_increasing).all()
+    block = ca_data_parser.get_county_block([1000, 1001], data)
+    assert numpy.isfinite(block.values["cases_pc"][block.present]).all()
+
+    baseline = {"1x/a": {"median": 0.010}, "1x/b": {"median": 0.010}, "1x/c": {"median": 0.00001}, "1x/rows": 5}
+    results = {"1x/a": {"median": 0.011}, "1x/b": {"median": 0.020}, "1x/c": {"median": 0.00003}, "1x/rows": 5}
+    assert benchmarks.find_regressions(baseline, results) == [("1x/b", 0.010, 0.020)]
+
+
+def test_loadtest(tmp_path):
+    filename, pops_filename = str(tmp_path / "us.csv"), str(tmp_path / "pops.csv")
+    benchmarks.write_counties_csv(filename, pops_filename, counties=120, days=60)
+    workdir = str(tmp_path / "server")
+    fips = loadtest.prepare_workdir(workdir, filename, pops_filename)
+    assert fips[0] == 1000 and len(fips) == 120 - benchmarks.STATES
+
+    mix = loadtest.RequestMix(fips, index_share=0.2)
+    rng = loadtest.random.Random(1)
+    requests = [mix.next(rng) for _ in range(2000)]
+    graphs = [body for kind, body in requests if kind == "graph"]
+    assert 0.15 < 1 - len(graphs) / len(requests) < 0.25
+    assert all(1 <= len(body["counties"]) <= 10 and body["chart"] in ca_data_parser.CHARTS for body in graphs)
+    # popular counties come up far more often than the rest
+    first = sum(mix.fips[0] in body["counties"] for body in graphs)
+    last = sum(mix.fips[-1] in body["counties"] for body in graphs)
+    assert first > 10 * max(last, 1)
+
+    port = loadtest.free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = loadtest.start_server(workdir, port)
+    try:
+        loadtest.wait_ready(url, server, timeout=60)
+        report = loadtest.run_loadtest(url, fips, concurrency=2, duration=3, pid=server.pid, sample_interval=0.5)
+    finally:
+        server.terminate()
+        server.wait()
+    assert report["requests"] > 0 and report["error_rate"] == 0
+    assert report["kinds"]["graph"]["p50"] <= report["kinds"]["graph"]["p99"]
+    assert report["timeline"] and all(sample["rss_mib"] > 0 for sample in report["timeline"])
+
+
+class CsvHandler(BaseHTTPRequestHandler):
+    """Stand-in for the raw file host: ETags, byte ranges and gzip."""
+    body = b""
+    requests = []
+
+    def do_GET(self):
+        etag = f'"{zlib.crc32(self.body)}"'
+        self.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        data = self.body
+        status = 200
+        headers = {"ETag": etag}
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes="):-1])
+            data = data[start:]
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{len(self.body) - 1}/{len(self.body)}"
+        elif "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = gzip.compress(data)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_refresh_csv(tmp_path):
+    lines = ["date,county,state,fips,cases,deaths\n",
+             "2020-03-01,Santa Clara,California,6085,1,0\n",
+             "2020-03-01,New York City,New York,,5,0\n",
+             "2020-03-02,Santa Clara,California,6085,4,1\n",
+             "2020-03-02,San Mateo,California,6081,2,0\n"]
+    CsvHandler.body = "".join(lines[:3]).encode()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CsvHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/us-counties.csv"
+    filename = str(tmp_path / "us-counties.csv")
+    mapping_filename = str(tmp_path / "mapping.json")
+    try:
+        assert update_csv_and_mappings.refresh(url, filename, mapping_filename)
+        assert open(filename, "rb").read() == CsvHandler.body
+        assert json.load(open(mapping_filename)) == {"California - Santa Clara": 6085, "New York - New York City": 36061}
+        assert CsvHandler.requests[-1].get("If-None-Match") is None
+
+        mtime = os.stat(filename).st_mtime_ns
+        assert not update_csv_and_mappings.refresh(url, filename, mapping_filename)
+        assert CsvHandler.requests[-1]["If-None-Match"] == f'"{zlib.crc32(CsvHandler.body)}"'
+        assert os.stat(filename).st_mtime_ns == mtime
+
+        CsvHandler.body = "".join(lines).encode()
+        assert update_csv_and_mappings.refresh(url, filename, mapping_filename)
+        assert CsvHandler.requests[-1]["Range"]
+        assert open(filename, "rb").read() == CsvHandler.body
+        assert json.load(open(mapping_filename))["California - San Mateo"] == 6081
+        assert not update_csv_and_mappings.refresh(url, filename, mapping_filename)
+
+        assert update_csv_and_mappings.refresh(url, filename, mapping_filename, full=True)
+        assert open(filename, "rb").read() == CsvHandler.body
+        assert sorted(os.listdir(tmp_path)) == ["mapping.json", "us-counties.csv", "us-counties.csv.validators.json"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """Stand-in for the web archive: a page of table cells per day, some of which fail."""
+    # day -> failures before it succeeds; -1 never does
+    failures = {}
+    requests = []
+
+    def do_GET(self):
+        day = self.path.split("/")[2]
+        self.requests.append(day)
+        if self.failures.get(day, 0):
+            self.failures[day] -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        data = (f'<div class="sccgov-responsive-table-cell"><div class="sccgov-responsive-table-cell-header">'
+                f'Total Cases</div><div class="sccgov-responsive-table-cell-content">{int(day) % 1000}</div></div>'
+                ).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureDriver:
+    """Just enough of a webdriver to load fixture pages."""
+    made = 0
+    quits = 0
+
+    def __init__(self):
+        FixtureDriver.made += 1
+
+    def get(self, url):
+        with urlopen(url) as response:
+            self.page_source = response.read().decode()
+
+    def quit(self):
+        FixtureDriver.quits += 1
+
+
+def test_backfill(tmp_path):
+    limiter = backfill.RateLimiter(50)
+    start = time.monotonic()
+    for _ in range(10):
+        limiter.wait()
+    assert time.monotonic() - start >= 9 / 50
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    archive_url = f"http://127.0.0.1:{server.server_address[1]}/web"
+    days = [f"202003{d}" for d in range(26, 20, -1)]
+    checkpoint = str(tmp_path / "checkpoint.jsonl")
+    crash_on = {"20200323"}
+
+    def fetch(driver, day):
+        if day in crash_on:
+            raise RuntimeError("crashed")
+        driver.get(f"{archive_url}/{day}/page.aspx")
+        return {"Date": day, "Total Cases": driver.page_source.split("content\">")[1].split("<")[0]}
+
+    ArchiveHandler.failures = {"20200324": 1, "20200322": -1}
+    try:
+        with pytest.raises(RuntimeError):
+            backfill.backfill(days, fetch, FixtureDriver, workers=1, backoff=0.01, retry_exceptions=(HTTPError,),
+                              checkpoint=checkpoint)
+        # the day that failed once was retried, on a fresh driver
+        assert ArchiveHandler.requests == ["20200326", "20200325", "20200324", "20200324"]
+        assert list(backfill.load_checkpoint(checkpoint)) == ["20200326", "20200325", "20200324"]
+        with open(checkpoint, "a") as f:
+            f.write('{"day": "2020')
+
+        crash_on.clear()
+        ArchiveHandler.requests = []
+        rows, failed = backfill.backfill(days, fetch, FixtureDriver, workers=3, rate=100, retries=2, backoff=0.01,
+                                         retry_exceptions=(HTTPError,), checkpoint=checkpoint)
+        # resumed: only the days not yet fetched were requested
+        assert sorted(ArchiveHandler.requests) == ["20200321", "20200322", "20200322", "20200322", "20200323"]
+        assert failed == ["20200322"]
+        assert rows == [{"Date": day, "Total Cases": str(int(day) % 1000)} for day in days if day != "20200322"]
+        # failed attempts got a fresh driver, and every driver was quit
+        assert FixtureDriver.made == FixtureDriver.quits >= 1 + 1 + 3
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,48 +1,172 @@
 #!/usr/bin/env python3
-import gzip
+import argparse
+import zlib
 from datetime import datetime
 import os
 import csv
 import json
+from urllib.error import HTTPError
 from urllib.request import Request, urlopen
 from collections import OrderedDict
 
 STATIC_FOLDER = os.path.join('static')
+# bytes of the local file re-requested when appending, to check the remote file still starts with it
+APPEND_OVERLAP_BYTES = 4096
+# bytes read from the response at a time when downloading the whole file
+CHUNK_SIZE = 64 * 1024
+# ETag and Last-Modified of the downloaded file are kept next to it in this file
+VALIDATORS_SUFFIX = ".validators.json"
+DECOMPRESS_WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
 
 
-def get_url(url, filename):
+def read_validators(filename):
+    try:
+        with open(filename + VALIDATORS_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_atomic(filename, data):
+    tmp_filename = f"{filename}.tmp-{os.getpid()}"
+    with open(tmp_filename, "w") as f:
+        f.write(data)
+    os.replace(tmp_filename, filename)
+
+
+def conditional_headers(validators):
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(response):
+    validators = {"etag": response.headers.get("ETag"),
+                  "last_modified": response.headers.get("Last-Modified")}
+    return {k: v for k, v in validators.items() if v}
+
+
+def stream_lines(response, f):
+    """
+    Copy the response body to f, decompressing it as it arrives, and yield it as text lines along the way.
+    """
+    encoding = response.info().get("Content-Encoding")
+    if encoding and encoding not in DECOMPRESS_WBITS:
+        raise Exception(f'Encoding type <{encoding}> unknown')
+    print(f"{encoding or 'non-encoded'} response")
+    decompressor = zlib.decompressobj(DECOMPRESS_WBITS[encoding]) if encoding else None
+    pending = b""
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if decompressor is not None:
+            data = decompressor.decompress(chunk) if chunk else decompressor.flush()
+        else:
+            data = chunk
+        f.write(data)
+        lines = (pending + data).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line.decode() + "\n"
+        if not chunk:
+            break
+    if pending:
+        yield pending.decode()
+
+
+def get_url(url, filename, validators=None, consume_lines=None):
+    """
+    Download url to filename, streaming it through a temporary file that replaces filename once complete.
+    :param validators: as returned by read_validators for the local copy, to skip the download if it's unchanged
+    :param consume_lines: called with an iterator over the file's lines as they are downloaded
+    :return: the new copy's validators and what consume_lines returned, or None if the remote file is unchanged
+    """
     req = Request(url)
     req.headers = {
         'Accept-Encoding': 'gzip, deflate',
+        **conditional_headers(validators or {}),
     }
-    response = urlopen(req)
-    encoding = response.info().get("Content-Encoding")
-    if encoding == "gzip":
-        print("gzipped response")
-        orig = response.read()
-        data = gzip.decompress(orig)
-        print(f"orig:{len(orig)}  gunzip:{len(data)} ratio:{len(orig)*100/len(data):.2f}")
-    elif encoding == 'deflate':
-        print("deflate response")
-        data = response.read()
-    elif encoding:
-        raise Exception(f'Encoding type <{encoding}> unknown')
-    else:
-        print("non-encoded response")
-        data = response.read()
-    with open(filename, "wb") as f:
-        f.write(data)
+    try:
+        response = urlopen(req)
+    except HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+    tmp_filename = f"{filename}.tmp-{os.getpid()}"
+    try:
+        with response, open(tmp_filename, "wb") as f:
+            lines = stream_lines(response, f)
+            result = consume_lines(lines) if consume_lines else None
+            # finish the download even if consume_lines stopped early
+            for _ in lines:
+                pass
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    return response_validators(response), result
 
 
-url = "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv"
-get_url(url, "us-counties.csv")
+def append_url(url, filename, validators=None):
+    """
+    Fetch only the bytes appended to url since filename was downloaded, and append them to filename.
+    The request overlaps the end of the local file, so a remote file that was rewritten rather than appended to
+    is detected.
+    :param validators: as returned by read_validators for the local copy, to skip the request if it's unchanged
+    :return: the appended bytes (empty if the remote file is unchanged) and the new validators,
+             or None if the whole file needs to be downloaded again
+    """
+    size = os.path.getsize(filename)
+    overlap = min(size, APPEND_OVERLAP_BYTES)
+    with open(filename, "rb") as f:
+        f.seek(size - overlap)
+        local_tail = f.read()
+    req = Request(url)
+    req.headers = {
+        'Range': f'bytes={size - overlap}-',
+        **conditional_headers(validators or {}),
+    }
+    try:
+        response = urlopen(req)
+    except HTTPError as e:
+        if e.code == 304:
+            return b"", validators
+        if e.code == 416:
+            print("remote file is smaller than local copy")
+            return None
+        raise
+    with response:
+        if response.status != 206:
+            print(f"range request not honored (status {response.status})")
+            return None
+        data = response.read()
+    if not data.startswith(local_tail):
+        print("remote file was rewritten, not appended to")
+        return None
+    data = data[overlap:]
+    # only append complete lines
+    data = data[:data.rfind(b"\n") + 1]
+    print(f"appending {len(data)} bytes")
+    if data:
+        with open(filename, "ab") as f:
+            f.write(data)
+    return data, response_validators(response)
 
-fips_county_dict = {}
-latest_date = datetime.min
-unknowns = set()
 
-with open('us-counties.csv', 'r') as f:
-    reader = csv.DictReader(f)
+def update_mapping(lines, fips_county_dict, unknowns):
+    """
+    Add the places in us-counties.csv rows to fips_county_dict.
+    :param lines: csv lines, including the header line
+    :return: latest date seen
+    """
+    latest_date = datetime.min
+    reader = csv.DictReader(lines)
     for row in reader:
         state = row['state']
         county = row['county']
@@ -60,10 +184,64 @@ with open('us-counties.csv', 'r') as f:
         fips_county_dict[place] = fips
         date = datetime.strptime(row['date'], "%Y-%m-%d")
         latest_date = max(latest_date, date)
+    return latest_date
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full", action="store_true",
+                        help="download the whole file even if a local copy exists")
+    return parser
+
+
+def refresh(url, filename, mapping_filename, full=False):
+    """
+    Bring filename up to date with url, and the fips mapping with it.
+    :param full: download the whole file even if there is a local copy
+    :return: False if nothing changed since the last refresh
+    """
+    have_local = not full and os.path.exists(filename) and os.path.exists(mapping_filename)
+    validators = read_validators(filename) if have_local else {}
+    appended = None
+    if have_local:
+        appended = append_url(url, filename, validators)
+
+    fips_county_dict = {}
+    unknowns = set()
+    if appended is None:
+        fetched = get_url(url, filename, validators,
+                          lambda lines: update_mapping(lines, fips_county_dict, unknowns))
+        if fetched is None:
+            print("not modified")
+            return False
+        validators, latest_date = fetched
+    else:
+        data, validators = appended
+        if not data:
+            print("not modified")
+            return False
+        # only the new rows can add places to the existing mapping
+        with open(mapping_filename) as f:
+            fips_county_dict = json.load(f)
+        with open(filename, 'r') as f:
+            header = f.readline()
+        latest_date = update_mapping([header] + data.decode().splitlines(), fips_county_dict, unknowns)
+
+    if latest_date != datetime.min:
+        print(f"Latest date: {latest_date.strftime('%Y-%m-%d')}")
+    fips_county_dict = OrderedDict(sorted(fips_county_dict.items()))
+    write_atomic(mapping_filename, json.dumps(fips_county_dict, separators=(',\n', ': ')))
+    write_atomic(filename + VALIDATORS_SUFFIX, json.dumps(validators))
+    return True
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    url = "https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv"
+    filename = "us-counties.csv"
+    mapping_filename = os.path.join(STATIC_FOLDER, 'fips_county_mapping.json')
+    refresh(url, filename, mapping_filename, args.full)
 
-print(f"Latest date: {latest_date.strftime('%Y-%m-%d')}")
-unknowns_list = "\n" + "\n".join(sorted(unknowns))
-fips_county_dict = OrderedDict(sorted(fips_county_dict.items()))
 
-with open(os.path.join(STATIC_FOLDER, 'fips_county_mapping.json'), 'w') as f:
-    json.dump(fips_county_dict, f, separators=(',\n', ': '))
+if __name__ == "__main__":
+    main()